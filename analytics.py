@@ -0,0 +1,292 @@
+"""Vectorised aggregates over logged messages for the analytics commands.
+
+Messages are handled as parallel NumPy arrays, one element per message, with users interned to
+small integer indices so they can be used directly with bincount. Queries are read in chunks of
+fixed size and folded into running aggregates, so memory depends on the chunk size and the
+number of distinct users rather than on the length of the history.
+"""
+import collections
+import threading
+import time
+
+import numpy
+
+def chunks(cursor, width, size=65536):
+    """Yields the rows of an integer-only query as (rows, width) int64 arrays of at most size rows."""
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        yield numpy.array(rows, dtype=numpy.int64).reshape(-1, width)
+
+def intern(values):
+    """Returns (ids, indices) such that ids[indices] == values, with ids sorted and unique."""
+    ids, indices = numpy.unique(values, return_inverse=True)
+    return ids, indices.astype(numpy.int32)
+
+def hour_histogram(times, weights=None):
+    """Returns the number of messages (or sum of weights) in each hour of the day, UTC."""
+    return numpy.bincount((times % 86400) // 3600, weights, minlength=24)
+
+def user_aggregates(users, count, words=None, times=None):
+    """Returns per-user (messages, words, earliest time) arrays of length count.
+
+    words and earliest are None when the corresponding column isn't given.
+    """
+    messages = numpy.bincount(users, minlength=count)
+    wordsums = numpy.bincount(users, words, minlength=count).astype(numpy.int64) if words is not None else None
+    earliest = None
+    if times is not None:
+        earliest = numpy.full(count, numpy.iinfo(numpy.int64).max, dtype=numpy.int64)
+        numpy.minimum.at(earliest, users, times)
+    return messages, wordsums, earliest
+
+def speaker_pairs(users, count):
+    """Counts how often each pair of users spoke directly after one another.
+
+    users is in message order. Returns (first, second, occurrences) arrays with first < second.
+    """
+    before = users[:-1].astype(numpy.int64)
+    after = users[1:].astype(numpy.int64)
+    changed = before != after
+    keys = numpy.minimum(before, after)[changed] * count + numpy.maximum(before, after)[changed]
+    keys, occurrences = numpy.unique(keys, return_counts=True)
+    return keys // count, keys % count, occurrences
+
+class PairCounter:
+    """Running speaker_pairs over messages fed in chunks, keyed by user id.
+
+    The last speaker of each chunk is carried into the next one, so the result is the same as
+    counting the whole stream at once. Holds one chunk plus one entry per pair of users.
+    """
+    __slots__ = ('counts', 'messages', 'last')
+
+    def __init__(self):
+        self.counts = {}
+        self.messages = 0
+        self.last = None
+
+    def add(self, users):
+        """Counts the next chunk of user ids, in message order."""
+        if not len(users):
+            return
+        self.messages += len(users)
+        if self.last is not None:
+            users = numpy.concatenate(([self.last], users))
+        self.last = users[-1]
+        ids, indices = intern(users)
+        first, second, occurrences = speaker_pairs(indices, len(ids))
+        for key, count in zip(zip(ids[first].tolist(), ids[second].tolist()), occurrences.tolist()):
+            self.counts[key] = self.counts.get(key, 0) + count
+
+    def add_pair(self, a, b, count=1):
+        """Counts a and b as having talked to each other, outside of message order (e.g. a mention)."""
+        if a != b:
+            key = (min(a, b), max(a, b))
+            self.counts[key] = self.counts.get(key, 0) + count
+
+    def copy(self):
+        other = PairCounter()
+        other.counts = dict(self.counts)
+        other.messages = self.messages
+        other.last = self.last
+        return other
+
+MESSAGE = numpy.dtype([('message', numpy.int64), ('time', numpy.int64), ('channel', numpy.int32), ('user', numpy.int32), ('type', numpy.int8), ('words', numpy.int32)])
+MENTION = numpy.dtype([('time', numpy.int64), ('channel', numpy.int32), ('user', numpy.int32), ('mentioned', numpy.int32)])
+
+class GuildColumns:
+    """One guild's logged messages as growable columns, in logging order.
+
+    Channels and users are interned: the channel and user columns hold indices into channel_ids and
+    user_ids. Mentions in created messages are kept as separate (time, channel, user, mentioned) rows.
+    """
+
+    def __init__(self):
+        self.rows = numpy.empty(1024, MESSAGE)
+        self.size = 0
+        self.mentions = numpy.empty(64, MENTION)
+        self.mention_size = 0
+        self.channel_ids = []
+        self.user_ids = []
+        self.channels = {}
+        self.users = {}
+        self.lock = threading.Lock()
+
+    @property
+    def nbytes(self):
+        return self.rows.nbytes + self.mentions.nbytes
+
+    def intern(self, values, ids, indices):
+        """Maps an array of ids to indices into ids, adding the ids not seen before."""
+        unique, inverse = numpy.unique(values, return_inverse=True)
+        lookup = numpy.empty(len(unique), numpy.int32)
+        for i, value in enumerate(unique.tolist()):
+            if value not in indices:
+                indices[value] = len(ids)
+                ids.append(value)
+            lookup[i] = indices[value]
+        return lookup[inverse]
+
+    def grow(self, array, size, extra):
+        if size + extra <= len(array):
+            return array
+        grown = numpy.empty(max(2 * len(array), size + extra), array.dtype)
+        grown[:size] = array[:size]
+        return grown
+
+    def append(self, rows):
+        """Appends (message, time, channel, user, type, words) rows."""
+        if not len(rows):
+            return
+        rows = numpy.array(rows, dtype=numpy.int64).reshape(-1, 6)
+        with self.lock:
+            self.rows = self.grow(self.rows, self.size, len(rows))
+            new = self.rows[self.size:self.size + len(rows)]
+            new['message'] = rows[:, 0]
+            new['time'] = rows[:, 1]
+            new['channel'] = self.intern(rows[:, 2], self.channel_ids, self.channels)
+            new['user'] = self.intern(rows[:, 3], self.user_ids, self.users)
+            new['type'] = rows[:, 4]
+            new['words'] = rows[:, 5]
+            self.size += len(rows)
+
+    def append_mentions(self, mentions):
+        """Appends (time, channel, user, mentioned user) rows."""
+        if not len(mentions):
+            return
+        mentions = numpy.array(mentions, dtype=numpy.int64).reshape(-1, 4)
+        with self.lock:
+            self.mentions = self.grow(self.mentions, self.mention_size, len(mentions))
+            new = self.mentions[self.mention_size:self.mention_size + len(mentions)]
+            new['time'] = mentions[:, 0]
+            new['channel'] = self.intern(mentions[:, 1], self.channel_ids, self.channels)
+            new['user'] = self.intern(mentions[:, 2], self.user_ids, self.users)
+            new['mentioned'] = self.intern(mentions[:, 3], self.user_ids, self.users)
+            self.mention_size += len(mentions)
+
+    def view(self, channel=None, user=None, type=None):
+        """Returns (rows, mentions, channel ids, user ids) as of now, with rows and mentions filtered.
+
+        The arrays are never written to again, so they can be used without holding the lock.
+        """
+        with self.lock:
+            rows = self.rows[:self.size]
+            mentions = self.mentions[:self.mention_size]
+            channel_ids = numpy.array(self.channel_ids, dtype=numpy.int64)
+            user_ids = numpy.array(self.user_ids, dtype=numpy.int64)
+            if channel is not None:
+                channel = self.channels.get(channel, -1)
+            if user is not None:
+                user = self.users.get(user, -1)
+        for column, value in (('channel', channel), ('user', user)):
+            if value is not None:
+                rows = rows[rows[column] == value]
+                mentions = mentions[mentions[column] == value]
+        if type is not None:
+            rows = rows[rows['type'] == type]
+        return rows, mentions, channel_ids, user_ids
+
+    def user_totals(self, channel=None, user=None, type=None, order='messages', limit=None):
+        """Returns (user, messages, words, earliest time) for each user, sorted by messages, words per message or messages per second."""
+        rows, _, _, user_ids = self.view(channel, user, type)
+        messages, words, earliest = user_aggregates(rows['user'], len(user_ids), rows['words'], rows['time'])
+        seen = messages.nonzero()[0]
+        messages, words, earliest = messages[seen], words[seen], earliest[seen]
+        key = {'messages': messages, 'words': words / messages, 'rate': messages / (time.time() - earliest + 1)}[order]
+        top = numpy.argsort(-key, kind='stable')[:limit]
+        return list(zip(user_ids[seen][top].tolist(), messages[top].tolist(), words[top].tolist(), earliest[top].tolist()))
+
+    def summary(self, channel=None, user=None, type=None):
+        """Returns (users, messages, words)."""
+        rows, _, _, _ = self.view(channel, user, type)
+        return (len(numpy.unique(rows['user'])), len(rows), int(rows['words'].sum()))
+
+    def channel_totals(self, user=None):
+        """Returns (channel, messages) for each channel with created messages, most messages first."""
+        rows, _, channel_ids, _ = self.view(user=user, type=0)
+        messages = numpy.bincount(rows['channel'], minlength=len(channel_ids))
+        seen = messages.nonzero()[0]
+        top = seen[numpy.argsort(-messages[seen], kind='stable')]
+        return list(zip(channel_ids[top].tolist(), messages[top].tolist()))
+
+    def hour_totals(self, channel=None, user=None):
+        """Returns the number of created messages in each hour of the day (UTC)."""
+        rows, _, _, _ = self.view(channel, user, type=0)
+        return hour_histogram(rows['time']).tolist()
+
+    def conversations(self, channel=None):
+        """Returns a PairCounter over the created messages, in time order, and their mentions."""
+        rows, mentions, _, user_ids = self.view(channel, type=0)
+        pairs = PairCounter()
+        pairs.add(user_ids[rows['user'][numpy.argsort(rows['time'], kind='stable')]])
+        for user, mentioned in zip(user_ids[mentions['user']].tolist(), user_ids[mentions['mentioned']].tolist()):
+            pairs.add_pair(user, mentioned)
+        return pairs
+
+class ColumnStore:
+    """GuildColumns for the guilds used recently, within a memory budget in bytes.
+
+    Guilds are loaded on first use. Messages committed while a guild loads are held back and
+    appended once it has loaded, unless the load already read them. The least recently used guilds
+    are evicted whenever the budget is exceeded.
+    """
+
+    def __init__(self, budget):
+        self.budget = budget
+        self.guilds = collections.OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.evictions = 0
+
+    def get(self, guild):
+        """Returns the guild's columns, or None if they aren't loaded."""
+        with self.lock:
+            columns = self.guilds.get(guild)
+            if columns is not None:
+                self.guilds.move_to_end(guild)
+            return columns
+
+    def begin_load(self, guild):
+        with self.lock:
+            self.pending.setdefault(guild, [])
+
+    def abort_load(self, guild):
+        with self.lock:
+            self.pending.pop(guild, None)
+
+    def finish_load(self, guild, columns, last):
+        """Makes the loaded columns available. last is the highest messages.id the load could see."""
+        with self.lock:
+            for id, row, mentions in self.pending.pop(guild, []):
+                if id > last:
+                    columns.append([row])
+                    columns.append_mentions(mentions)
+            self.guilds[guild] = columns
+            self.evict()
+
+    def append(self, guild, id, row, mentions):
+        """Adds a committed (message, time, channel, user, type, words) row with the given messages.id and its mentions to a loaded or loading guild."""
+        with self.lock:
+            if guild in self.pending:
+                self.pending[guild].append((id, row, mentions))
+            elif guild in self.guilds:
+                self.guilds[guild].append([row])
+                self.guilds[guild].append_mentions(mentions)
+                self.evict()
+
+    def evict(self):
+        while len(self.guilds) > 1 and self.nbytes() > self.budget:
+            self.guilds.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self):
+        """Drops every loaded guild, e.g. after the log was changed other than by logging; they reload on next use."""
+        with self.lock:
+            self.guilds.clear()
+
+    def nbytes(self):
+        return sum(columns.nbytes for columns in self.guilds.values())
+
+    def __len__(self):
+        return len(self.guilds)
@@ -0,0 +1,242 @@
+"""Generates a large synthetic logs.db and times the analytics commands' data paths against it.
+
+    python bench_analytics.py generate DIR [--messages N] [--guilds N] [--channels N] [--users N] [--days N] [--seed N]
+    python bench_analytics.py run DIR [--repeat N] [--query SQL] [benchmark ...]
+
+generate fills DIR/logs.db without connecting to Discord: guilds, channels within a guild and users
+are picked with Zipf-like weights, messages follow a day/night cycle over the last --days days, and
+a few are edits, DMs, mentions or attachments. run times each benchmark against the busiest guild
+in a process of its own, so that its peak RSS isn't hidden by an earlier one, and reports the best
+wall time of --repeat runs.
+"""
+import argparse
+import json
+import os
+import resource
+import sqlite3
+import subprocess
+import sys
+import time
+
+DEFAULT_QUERY = "SELECT * FROM log ORDER BY time DESC LIMIT 100"
+
+WORDS = ("the of and to a in is you that it he was for on are as with his they at be this have from or one had by word but not what all were "
+         "we when your can said there use an each which she do how their if will up other about out many then them these so some her would").split()
+
+def zipf(rng, count, size, exponent=1.1):
+    """Draws size indices below count, index i having weight 1 / (i + 1) ** exponent."""
+    import numpy
+    weights = 1 / numpy.arange(1, count + 1) ** exponent
+    return rng.choice(count, size=size, p=weights / weights.sum())
+
+def generate(directory, messages, guilds, channels, users, days, seed, chunk=200000):
+    import numpy
+    import selfbot
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, 'logs.db')
+    if os.path.exists(path):
+        sys.exit("{} already exists".format(path))
+    rng = numpy.random.default_rng(seed)
+    db = sqlite3.connect(path, isolation_level=None)
+    db.execute('pragma journal_mode=WAL')
+    db.execute('pragma synchronous=OFF')
+    # Messages go in before the full-text index exists, as in a database upgraded from before it
+    for target, script in enumerate(selfbot.MIGRATIONS[:3], 1):
+        db.executescript('BEGIN;\n' + script + '\nPRAGMA user_version = {};\nCOMMIT;'.format(target))
+
+    user_ids = 10 ** 17 + numpy.arange(users)
+    guild_ids = 10 ** 16 + numpy.arange(guilds)
+    channel_ids = 10 ** 15 + numpy.arange(guilds * channels).reshape(guilds, channels)
+    private_ids = 2 * 10 ** 15 + numpy.arange(min(users, 100))
+    ranks = numpy.array([rng.permutation(users) for _ in range(guilds)]) # each guild has its own most active users
+    db.execute('BEGIN')
+    db.executemany('INSERT INTO users(user, name) VALUES (?, ?)', ((int(user), "user{}".format(i)) for i, user in enumerate(user_ids)))
+    db.executemany('INSERT INTO guilds(guild, name) VALUES (?, ?)', ((int(guild), "guild{}".format(g)) for g, guild in enumerate(guild_ids)))
+    db.executemany('INSERT INTO channels(channel, guild, name) VALUES (?, ?, ?)',
+                   ((int(channel_ids[g, c]), int(guild_ids[g]), "channel{}".format(c)) for g in range(guilds) for c in range(channels)))
+    db.executemany('INSERT INTO channels(channel, guild, name) VALUES (?, NULL, ?)', ((int(channel), "user{}#0001".format(i)) for i, channel in enumerate(private_ids)))
+    db.executemany('INSERT INTO nicks(guild, user, nick) VALUES (?, ?, ?)',
+                   ((int(guild), int(user), "nick{}".format(i) if rng.random() < 0.3 else None) for guild in guild_ids for i, user in enumerate(user_ids)))
+    db.execute('COMMIT')
+
+    # Busy evenings, quiet early mornings (UTC)
+    hours = 1 + numpy.sin((numpy.arange(24) - 9) / 24 * 2 * numpy.pi)
+    end = int(time.time())
+    times = numpy.sort(end - days * 86400 + rng.integers(0, days, messages) * 86400
+                       + rng.choice(24, messages, p=hours / hours.sum()) * 3600 + rng.integers(0, 3600, messages))
+    start = time.monotonic()
+    for low in range(0, messages, chunk):
+        size = min(chunk, messages - low)
+        guild = zipf(rng, guilds, size, 0.8)
+        channel = channel_ids[guild, zipf(rng, channels, size)]
+        user = user_ids[ranks[guild, zipf(rng, users, size)]]
+        private = rng.random(size) < 0.02
+        types = (rng.random(size) < 0.03).astype(int)
+        lengths = numpy.minimum(rng.geometric(0.12, size), 200)
+        words = rng.integers(0, len(WORDS), int(lengths.sum()))
+        mentions = numpy.where(rng.random(size) < 0.05, user_ids[rng.integers(0, users, size)], 0)
+        attachments = rng.random(size) < 0.03
+        rows = []
+        offset = 0
+        for i in range(size):
+            text = ' '.join(WORDS[w] for w in words[offset:offset + lengths[i]])
+            offset += lengths[i]
+            if mentions[i]:
+                text += " <@{}>".format(mentions[i])
+            text += " https://cdn.example/{}.png".format(low + i) if attachments[i] else " "
+            if private[i]:
+                rows.append((None, int(private_ids[user[i] % len(private_ids)]), low + i, int(user[i]), text, int(times[low + i]), int(types[i])))
+            else:
+                rows.append((int(guild_ids[guild[i]]), int(channel[i]), low + i, int(user[i]), text, int(times[low + i]), int(types[i])))
+        db.execute('BEGIN')
+        db.executemany('INSERT INTO messages(guild, channel, message, user, text, time, type) VALUES (?, ?, ?, ?, ?, ?, ?)', rows)
+        db.execute('COMMIT')
+        done = low + size
+        print("{}/{} messages ({:.0f}/s)".format(done, messages, done / (time.monotonic() - start)), end='\r', flush=True)
+    print()
+    db.close()
+
+    os.chdir(directory)
+    bot = selfbot.SelfBot()
+    bot.load() # the remaining migrations
+    print("Rebuilt {} rollup rows in {:.1f}s".format(*bot.rebuild_rollups()))
+    bot.maintain()
+    bot.logwriter.stop()
+    bot.log_listener.stop()
+
+def open_bot(directory):
+    import selfbot
+    os.chdir(directory)
+    bot = selfbot.SelfBot()
+    bot.conf['query_timeout'] = bot.conf.get('query_timeout', 600)
+    bot.load()
+    bot.logwriter.stop() # nothing is logged here; keep the writer from holding the database
+    return bot
+
+def busiest(bot):
+    """Returns (guild, its busiest channel, its busiest user, its least active user)."""
+    guild = bot.logdb.execute('SELECT guild FROM rollups GROUP BY guild ORDER BY sum(messages) DESC LIMIT 1').fetchone()[0]
+    channel = bot.logdb.execute('SELECT channel FROM rollups WHERE guild = ? GROUP BY channel ORDER BY sum(messages) DESC LIMIT 1', (guild,)).fetchone()[0]
+    users = bot.logdb.execute('SELECT user, sum(messages) AS total FROM rollups WHERE guild = ? GROUP BY user ORDER BY total DESC', (guild,)).fetchall()
+    return guild, channel, users[0][0], users[-1][0]
+
+def stats(bot, guild, channel, user, rare):
+    count, graph = bot.conversation_graph(guild)
+    bot.user_totals(guild, type=0, limit=10)
+    bot.hour_totals(guild)
+    return "{} messages, {} pairs".format(count, len(graph))
+
+def stats_cached(bot, guild, channel, user, rare):
+    stats(bot, guild, channel, user, rare)
+    start = time.perf_counter()
+    stats(bot, guild, channel, user, rare)
+    return "second run {:.3f}s".format(time.perf_counter() - start)
+
+def stats_channel(bot, guild, channel, user, rare):
+    count, graph = bot.conversation_graph(guild, channel)
+    bot.user_totals(guild, channel, type=0, limit=10)
+    bot.hour_totals(guild, channel, user)
+    return "{} messages, {} pairs".format(count, len(graph))
+
+def stats_columns(bot, guild, channel, user, rare):
+    import analytics
+    bot.columns = analytics.ColumnStore(1 << 40)
+    bot.columns.begin_load(guild)
+    bot.read_columns(guild)
+    start = time.perf_counter()
+    result = stats(bot, guild, channel, user, rare)
+    return "{}, {:.1f}MiB of columns, query {:.3f}s".format(result, bot.columns.nbytes() / 1024 / 1024, time.perf_counter() - start)
+
+def topusers(bot, guild, channel, user, rare):
+    users, messages, words = bot.rollup_summary(guild)
+    for order in bot.USER_ORDERS:
+        bot.user_totals(guild, order=order, limit=10)
+    bot.user_totals(guild, user=user)
+    return "{} users, {} messages".format(users, messages)
+
+def topchans(bot, guild, channel, user, rare):
+    return "{} channels".format(len(bot.channel_totals(guild)))
+
+def seen(bot, guild, channel, user, rare):
+    return "busiest {}, least active {}".format(*((bot.last_seen(user) or ("never",))[0] for user in (user, rare)))
+
+def query_log(bot, guild, channel, user, rare, query=DEFAULT_QUERY):
+    description, rows, truncated = bot.run_query(query)
+    return "{} rows{}".format(len(rows), " (truncated)" if truncated else "")
+
+BENCHMARKS = {
+    'stats': stats,
+    'stats-cached': stats_cached,
+    'stats-channel': stats_channel,
+    'stats-columns': stats_columns,
+    'topusers': topusers,
+    'topchans': topchans,
+    'seen': seen,
+    'query-log': query_log,
+}
+
+def child(directory, name, query):
+    """Runs one benchmark and prints its result as JSON."""
+    bot = open_bot(directory)
+    targets = busiest(bot)
+    extra = {'query': query} if name == 'query-log' else {}
+    baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    start = time.perf_counter()
+    try:
+        result = BENCHMARKS[name](bot, *targets, **extra)
+    except Exception as e:
+        result = "failed: {!r}".format(e)
+    elapsed = time.perf_counter() - start
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    bot.log_listener.stop()
+    print(json.dumps({'name': name, 'elapsed': elapsed, 'baseline': baseline, 'peak': peak, 'result': result}))
+
+def run(directory, names, repeat, query):
+    size = sum(os.path.getsize(os.path.join(directory, name)) for name in ('logs.db', 'logs.db-wal') if os.path.exists(os.path.join(directory, name)))
+    print("Database: {:.1f} MiB".format(size / 1024 / 1024))
+    print("{:<15} {:>10} {:>10} {:>12}  {}".format("benchmark", "best (s)", "peak MiB", "+ over base", "result"))
+    for name in names:
+        results = []
+        for _ in range(repeat):
+            output = subprocess.run([sys.executable, os.path.abspath(__file__), 'child', directory, name, '--query', query], stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+            results.append(json.loads(output.strip().split('\n')[-1]))
+        best = min(results, key=lambda result: result['elapsed'])
+        print("{:<15} {:>10.3f} {:>10.1f} {:>12.1f}  {}".format(name, best['elapsed'], best['peak'] / 1024, (best['peak'] - best['baseline']) / 1024, best['result']))
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+    commands.required = True
+    generator = commands.add_parser('generate')
+    generator.add_argument('directory')
+    generator.add_argument('--messages', type=int, default=10000000)
+    generator.add_argument('--guilds', type=int, default=5)
+    generator.add_argument('--channels', type=int, default=40)
+    generator.add_argument('--users', type=int, default=5000)
+    generator.add_argument('--days', type=int, default=730)
+    generator.add_argument('--seed', type=int, default=0)
+    runner = commands.add_parser('run')
+    runner.add_argument('directory')
+    runner.add_argument('--repeat', type=int, default=1)
+    runner.add_argument('--query', default=DEFAULT_QUERY, help="the query timed by query-log")
+    runner.add_argument('benchmarks', nargs='*', metavar='benchmark', help="any of {} (default: all)".format(', '.join(BENCHMARKS)))
+    single = commands.add_parser('child')
+    single.add_argument('directory')
+    single.add_argument('name', choices=list(BENCHMARKS))
+    single.add_argument('--query', default=DEFAULT_QUERY)
+    args = parser.parse_args()
+    if args.command == 'run':
+        for name in args.benchmarks:
+            if name not in BENCHMARKS:
+                parser.error("unknown benchmark {}".format(name))
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    if args.command == 'generate':
+        generate(os.path.abspath(args.directory), args.messages, args.guilds, args.channels, args.users, args.days, args.seed)
+    elif args.command == 'run':
+        run(os.path.abspath(args.directory), args.benchmarks or list(BENCHMARKS), args.repeat, args.query)
+    else:
+        child(os.path.abspath(args.directory), args.name, args.query)
+
+if __name__ == "__main__":
+    main()
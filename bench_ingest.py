@@ -0,0 +1,180 @@
+"""Replays synthetic messages through the bot's on_message and on_message_edit handlers.
+
+Runs against a fresh logs.db in a temporary directory, without connecting to Discord, and reports
+handler throughput, p50/p99 handler latency and how much the database grew. Usage:
+
+    python bench_ingest.py [--messages N] [--guilds N] [--channels N] [--users N] [--seed N]
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import shutil
+import tempfile
+import time
+import types
+
+import discord
+
+import selfbot
+
+class FakeGuild:
+    __slots__ = ('id', 'name', 'members')
+
+    def __init__(self, id, name, members):
+        self.id = id
+        self.name = name
+        self.members = members
+
+    def get_member(self, user):
+        return self.members.get(user)
+
+class FakeUser:
+    __slots__ = ('id', 'name', 'discriminator', 'nick', 'display_name')
+
+    def __init__(self, id, name, nick=None):
+        self.id = id
+        self.name = name
+        self.discriminator = "{:04}".format(id % 10000)
+        self.nick = nick
+        self.display_name = nick or name
+
+class FakeTextChannel(discord.TextChannel):
+    __slots__ = ()
+
+    def __init__(self, id, guild, name):
+        self.id = id
+        self.guild = guild
+        self.name = name
+
+class FakeDMChannel(discord.DMChannel):
+    __slots__ = ()
+
+    def __init__(self, id, recipient):
+        self.id = id
+        self.recipient = recipient
+
+class FakeGroupChannel(discord.GroupChannel):
+    __slots__ = ()
+
+    def __init__(self, id, name, recipients):
+        self.id = id
+        self.name = name
+        self.recipients = recipients
+
+class FakeAttachment:
+    __slots__ = ('url',)
+
+    def __init__(self, url):
+        self.url = url
+
+class FakeMessage:
+    __slots__ = ('id', 'channel', 'guild', 'author', 'content', 'clean_content', 'attachments', 'created_at', 'edited_at', 'embeds')
+
+    def __init__(self, id, channel, author, content, attachments, created_at, edited_at=None):
+        self.id = id
+        self.channel = channel
+        self.guild = getattr(channel, 'guild', None)
+        self.author = author
+        self.content = content
+        self.clean_content = content
+        self.attachments = attachments
+        self.created_at = created_at
+        self.edited_at = edited_at
+        self.embeds = []
+
+WORDS = "the of and to a in is you that it he was for on are as with his they at be this have from or one had by word but not what all were".split()
+
+def generate(count, guilds, channels, users, rng):
+    """Yields (handler name, args) for count synthetic events: mostly guild messages, some DMs and group messages, attachments and edits."""
+    people = [FakeUser(1000 + i, "user{}".format(i)) for i in range(users)]
+    servers = []
+    for g in range(guilds):
+        members = {user.id: FakeUser(user.id, user.name, rng.choice([None, "nick{}".format(user.id)])) for user in rng.sample(people, max(1, users // 2))}
+        guild = FakeGuild(10 + g, "guild{}".format(g), members)
+        servers.append((guild, [FakeTextChannel(100000 + g * 1000 + c, guild, "channel{}".format(c)) for c in range(channels)], list(members.values())))
+    private = [FakeDMChannel(900000 + i, people[i]) for i in range(min(users, 20))]
+    private += [FakeGroupChannel(950000 + i, "group{}".format(i), rng.sample(people, min(users, 3))) for i in range(5)]
+    now = datetime.datetime.utcnow()
+    sent = []
+    for i in range(count):
+        created = now - datetime.timedelta(seconds=count - i)
+        if sent and rng.random() < 0.05:
+            before = rng.choice(sent)
+            after = FakeMessage(before.id, before.channel, before.author, before.content + " (edited)", before.attachments, before.created_at, created)
+            yield 'on_message_edit', (before, after)
+            continue
+        if rng.random() < 0.1:
+            channel = rng.choice(private)
+            author = rng.choice(people)
+        else:
+            guild, textchannels, members = rng.choice(servers)
+            channel = rng.choice(textchannels)
+            author = rng.choice(members)
+        text = ' '.join(rng.choice(WORDS) for _ in range(rng.randint(1, 30)))
+        if rng.random() < 0.1:
+            text += " <@{}>".format(rng.choice(people).id)
+        attachments = [FakeAttachment("https://cdn.example/{}.png".format(i))] if rng.random() < 0.05 else []
+        message = FakeMessage(10 ** 15 + i, channel, author, text, attachments, created)
+        sent.append(message)
+        if len(sent) > 1000:
+            sent.pop(0)
+        yield 'on_message', (message,)
+
+def database_size():
+    return sum(os.path.getsize(name) for name in ('logs.db', 'logs.db-wal') if os.path.exists(name))
+
+def percentile(samples, fraction):
+    return samples[int(fraction * (len(samples) - 1))] if samples else 0
+
+async def replay(bot, events):
+    latencies = []
+    for name, args in events:
+        handler = getattr(bot.client, name)
+        start = time.perf_counter()
+        await handler(*args)
+        latencies.append(time.perf_counter() - start)
+    return latencies
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--messages', type=int, default=50000)
+    parser.add_argument('--guilds', type=int, default=5)
+    parser.add_argument('--channels', type=int, default=10)
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='bench_ingest')
+    cwd = os.getcwd()
+    os.chdir(directory)
+    try:
+        bot = selfbot.SelfBot()
+        bot.load()
+        bot.register_events()
+        bot.client._connection.user = types.SimpleNamespace(id=1) # nobody else's messages are commands
+        events = list(generate(args.messages, args.guilds, args.channels, args.users, random.Random(args.seed)))
+        initial = database_size()
+
+        start = time.perf_counter()
+        latencies = bot.client.loop.run_until_complete(replay(bot, events))
+        handled = time.perf_counter() - start
+        bot.logwriter.stop()
+        drained = time.perf_counter() - start
+        bot.log_listener.stop()
+
+        latencies.sort()
+        grown = database_size() - initial
+        print("Events:              {} ({} edits)".format(len(events), sum(1 for name, _ in events if name == 'on_message_edit')))
+        print("Handler throughput:  {:.0f} events/s ({:.2f}s)".format(len(events) / handled, handled))
+        print("Written throughput:  {:.0f} events/s ({:.2f}s including writer drain)".format(len(events) / drained, drained))
+        print("Handler latency:     p50 {:.1f}us, p99 {:.1f}us, max {:.1f}us".format(percentile(latencies, 0.5) * 1e6, percentile(latencies, 0.99) * 1e6, latencies[-1] * 1e6))
+        print("Log writer:          {} records in {} batches, {} failed".format(bot.logwriter.written, bot.logwriter.batches, bot.logwriter.errors))
+        print("Database growth:     {:.1f} KiB ({:.0f} bytes/event)".format(grown / 1024, grown / len(events)))
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -12,21 +12,140 @@ import math
 import copy
 import time
 import shlex
+import string
 import random
 import subprocess
+import signal
 import collections
+import queue
+import heapq
+import itertools
+import concurrent.futures
+import functools
+import multiprocessing
+import threading
+import cProfile
+import pstats
+import tracemalloc
+import marshal
+import logging
+import logging.handlers
 from io import BytesIO, StringIO
 
 MAX_RECURSION_DEPTH = 10
-MENTION_REGEX = r"<@!>(\d+)>"
+MENTION_REGEX = re.compile(r"<@!?(\d+)>")
+
+log = logging.getLogger('selfbot')
+
+# Log database schema, one script per version (pragma user_version). Append only, never edit.
+MIGRATIONS = [
+    # 1: initial schema; a no-op for databases created before versioning
+    '''
+    CREATE TABLE IF NOT EXISTS messages(
+        id INTEGER NOT NULL PRIMARY KEY,
+        guild INTEGER,
+        channel INTEGER NOT NULL,
+        message INTEGER NOT NULL,
+        user INTEGER NOT NULL,
+        text TEXT NOT NULL,
+        time INTEGER NOT NULL,
+        type TINYINT NOT NULL CHECK (type IN (0,1)),
+        FOREIGN KEY(guild) REFERENCES guilds(guild),
+        FOREIGN KEY(channel) REFERENCES channels(channel),
+        FOREIGN KEY(user) REFERENCES users(user)); -- type: 0 (created), 1 (edited)
+    CREATE TABLE IF NOT EXISTS guilds(
+        guild INTEGER NOT NULL PRIMARY KEY,
+        name TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS channels(
+        channel INTEGER NOT NULL PRIMARY KEY,
+        guild INTEGER,
+        name TEXT NOT NULL,
+        FOREIGN KEY(guild) REFERENCES guilds(guild));
+    CREATE TABLE IF NOT EXISTS users(
+        user INTEGER NOT NULL PRIMARY KEY,
+        name TEXT NOT NULL);
+    CREATE TABLE IF NOT EXISTS nicks(
+        guild INTEGER NOT NULL,
+        user INTEGER NOT NULL,
+        nick TEXT,
+        PRIMARY KEY(guild, user),
+        FOREIGN KEY(guild) REFERENCES guilds(guild),
+        FOREIGN KEY(user) REFERENCES users(user));
+    CREATE VIEW IF NOT EXISTS log AS
+    SELECT time, timestamp, guild, channel, name, text, CASE type WHEN 0 THEN 'CREATE' ELSE 'EDIT' END AS type FROM (
+        SELECT m.time, datetime(m.time, 'unixepoch') as timestamp, g.name as guild, c.name as channel, CASE WHEN n.nick IS NULL THEN u.name ELSE n.nick END as name, m.text, m.type FROM messages AS m
+        INNER JOIN guilds AS g ON m.guild = g.guild
+        INNER JOIN channels AS c ON m.channel = c.channel
+        INNER JOIN users AS u ON m.user = u.user
+        INNER JOIN nicks AS n ON m.guild = n.guild AND m.user = n.user
+        WHERE m.guild IS NOT NULL
+        UNION
+        SELECT m.time, datetime(m.time, 'unixepoch') as timestamp, NULL as guild, c.name as channel, u.name as name, m.text, m.type FROM messages AS m
+        INNER JOIN channels AS c ON m.channel = c.channel
+        INNER JOIN users AS u ON m.user = u.user
+        WHERE m.guild IS NULL
+    ) ORDER BY time;
+    ''',
+    # 2: indexes for seen, stats, topusers and topchans
+    '''
+    CREATE INDEX IF NOT EXISTS messages_guild_channel_type_time ON messages(guild, channel, type, time);
+    CREATE INDEX IF NOT EXISTS messages_guild_type_time ON messages(guild, type, time);
+    CREATE INDEX IF NOT EXISTS messages_user_time ON messages(user, time);
+    ANALYZE;
+    ''',
+    # 3: per (guild, channel, user, type, hour) message and word counts, maintained by LogWriter.
+    # Existing messages are counted in the background by SelfBot.backfill_rollups.
+    '''
+    CREATE TABLE IF NOT EXISTS rollups(
+        guild INTEGER NOT NULL,
+        channel INTEGER NOT NULL,
+        user INTEGER NOT NULL,
+        type TINYINT NOT NULL,
+        hour INTEGER NOT NULL, -- time / 3600
+        messages INTEGER NOT NULL,
+        words INTEGER NOT NULL,
+        first INTEGER NOT NULL, -- time of the earliest message in the bucket
+        PRIMARY KEY(guild, channel, user, type, hour)) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS rollups_guild_user ON rollups(guild, user);
+    ''',
+    # 4: full-text index over messages.text. Rows up to backfills.last are indexed in the background
+    # by SelfBot.backfill_fts; done is how far it has got.
+    '''
+    CREATE TABLE IF NOT EXISTS backfills(
+        name TEXT NOT NULL PRIMARY KEY,
+        done INTEGER NOT NULL,
+        last INTEGER NOT NULL);
+    INSERT OR IGNORE INTO backfills(name, done, last) SELECT 'messages_fts', 0, coalesce(max(id), 0) FROM messages;
+    CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(text, content='messages', content_rowid='id');
+    CREATE TRIGGER IF NOT EXISTS messages_fts_insert AFTER INSERT ON messages BEGIN
+        INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+    END;
+    CREATE TRIGGER IF NOT EXISTS messages_fts_delete AFTER DELETE ON messages
+    WHEN old.id <= (SELECT done FROM backfills WHERE name = 'messages_fts') OR old.id > (SELECT last FROM backfills WHERE name = 'messages_fts') BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+    END;
+    CREATE TRIGGER IF NOT EXISTS messages_fts_update AFTER UPDATE OF text ON messages
+    WHEN old.id <= (SELECT done FROM backfills WHERE name = 'messages_fts') OR old.id > (SELECT last FROM backfills WHERE name = 'messages_fts') BEGIN
+        INSERT INTO messages_fts(messages_fts, rowid, text) VALUES ('delete', old.id, old.text);
+        INSERT INTO messages_fts(rowid, text) VALUES (new.id, new.text);
+    END;
+    ''',
+    # 5: scheduled commands, reloaded on startup
+    '''
+    CREATE TABLE IF NOT EXISTS schedule(
+        id INTEGER NOT NULL PRIMARY KEY,
+        due REAL NOT NULL, -- unix time
+        channel INTEGER NOT NULL,
+        message INTEGER NOT NULL,
+        command TEXT NOT NULL,
+        recursion INTEGER NOT NULL,
+        interval REAL); -- seconds between runs, NULL for one-off commands
+    ''',
+]
 
 class SelfBot:
     def __init__(self):
         self.client = discord.Client(fetch_offline_members=False, heartbeat_timeout=30)
-
-        self.commands = {}
-        self.aliases = {}
-        self.scheduler = {}
         self.conf = {"prefix": "//", "token": "Your-token-here"}
 
         if os.path.isfile('conf.json'):
@@ -35,82 +154,459 @@ class SelfBot:
         else:
             with open('conf.json', 'w') as config_file:
                 config_file.write(json.dumps(self.conf, indent=4))
+        self.start_logging()
+
+        self.commands = {}
+        self.aliases = {}
+        self.aliases_mtime = None
+        self.alias_chains = {}
+        self.scheduler = {}
+        self.shell_jobs = {}
+        self.query_pool = concurrent.futures.ThreadPoolExecutor(self.conf.get('query_workers', 2), thread_name_prefix="query")
+        self.readers = threading.local()
+        self.slow_queries = collections.deque(maxlen=50)
+        self.render_pools = set()
+        self.render_idle = None
+        self.renders = {}
+        self.results = ResultCache(self.conf.get('result_cache_size', 128))
+        self.columns = None
+        self.column_loads = {}
+        self.replies = {}
+        self.lag = None
+        self.stopping = threading.Event() # tells background jobs to stop between chunks
+        self.schedule_heap = []
+        self.schedule_wakeup = asyncio.Event()
+        self.scheduler_slots = asyncio.Semaphore(self.conf.get('scheduler_concurrency', 4))
+
+    def start_logging(self):
+        """Routes log records through a queue to a thread that writes them to rotating log files and the console.
+
+        The console only shows console_log_level and up. log_levels sets the level of any logger, e.g.
+        selfbot.messages.<guild id> or selfbot.messages.<guild id>.<channel id> for one guild's or channel's messages.
+        """
+        records = queue.Queue()
+        logfile = logging.handlers.RotatingFileHandler(self.conf.get('log_file', 'selfbot.log'), maxBytes=self.conf.get('log_file_bytes', 10 * 1024 * 1024),
+                                                       backupCount=self.conf.get('log_file_count', 5), encoding='utf-8')
+        logfile.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s: %(message)s'))
+        console = logging.StreamHandler()
+        console.setLevel(self.conf.get('console_log_level', 'WARNING'))
+        console.setFormatter(logging.Formatter('%(levelname)s %(name)s: %(message)s'))
+        console.addFilter(lambda record: not record.name.startswith('asyncio')) # e.g. slow callback reports; the log file has them
+        self.log_listener = logging.handlers.QueueListener(records, logfile, console, respect_handler_level=True)
+        root = logging.getLogger()
+        root.addHandler(LogQueueHandler(records))
+        root.setLevel(logging.INFO)
+        for name, level in self.conf.get('log_levels', {}).items():
+            logging.getLogger(name).setLevel(level)
+        self.log_listener.start()
+
+    def message_logger(self, message):
+        """Returns the logger for message's channel: selfbot.messages.<guild id>.<channel id>, or selfbot.messages.private.<channel id>."""
+        return logging.getLogger('selfbot.messages.{}.{}'.format(message.guild.id if message.guild else 'private', message.channel.id))
 
     def load(self):
         if os.path.isfile('aliases.json'):
-            with open('aliases.json', 'r') as aliases_file:
-                self.aliases = json.load(aliases_file)
+            self.load_aliases()
         else:
-            with open('aliases.json', 'w') as aliases_file:
-                aliases_file.write(json.dumps(self.aliases, indent=4))
-
-        if os.path.isfile('logs.db'):
-            self.logdb = sqlite3.connect('logs.db')
-            cursor = self.logdb.cursor()
-            cursor.execute('pragma foreign_keys=ON')
-            cursor.execute('vacuum')
+            self.save_aliases()
+
+        self.logdb = sqlite3.connect('logs.db')
+        cursor = self.logdb.cursor()
+        cursor.execute('pragma foreign_keys=ON')
+        cursor.execute('pragma auto_vacuum=INCREMENTAL') # only takes effect on new databases or after a full vacuum
+        cursor.execute('pragma journal_mode=WAL')
+        cursor.execute('pragma synchronous=NORMAL')
+        self.migrate()
+
+        self.dimcache = DimensionCache(self.conf.get('dimension_cache_size', 10000))
+        self.dimcache.warm(self.logdb)
+        self.logwriter = LogWriter('logs.db', batch_size=self.conf.get('log_batch_size', 500), max_latency=self.conf.get('log_max_latency', 1.0), on_commit=self.columns_logged, on_failure=self.dimcache.forget)
+        self.logwriter.start()
+        if self.conf.get('column_store', False):
+            import analytics
+            self.columns = analytics.ColumnStore(self.conf.get('column_store_mb', 256) * 1024 * 1024)
+
+    def load_aliases(self):
+        with open('aliases.json', 'r') as aliases_file:
+            self.aliases = json.load(aliases_file)
+        self.aliases_mtime = os.stat('aliases.json').st_mtime_ns
+        self.alias_chains = {}
+
+    def save_aliases(self):
+        with open('aliases.json', 'w') as aliases_file:
+            json.dump(self.aliases, aliases_file, indent=4)
+        self.aliases_mtime = os.stat('aliases.json').st_mtime_ns
+        self.alias_chains = {}
+
+    def alias_chain(self, alias):
+        """Returns (command, templates): the command alias finally runs and the AliasTemplates its parameters go through on the way.
+
+        Chains are remembered until aliases.json changes. Raises ValueError if the chain loops.
+        """
+        try:
+            if os.stat('aliases.json').st_mtime_ns != self.aliases_mtime:
+                self.load_aliases()
+        except FileNotFoundError:
+            pass
+        chain = self.alias_chains.get(alias)
+        if chain is None:
+            command = alias
+            seen = [alias]
+            templates = []
+            while command in self.aliases and command not in self.commands:
+                command, _, template = self.aliases[command].partition(' ')
+                templates.append(AliasTemplate(template))
+                if command in seen:
+                    raise ValueError("alias loop: {}".format(' -> '.join(seen + [command])))
+                seen.append(command)
+            chain = self.alias_chains[alias] = (command, templates)
+        return chain
+
+    def migrate(self):
+        cursor = self.logdb.cursor()
+        version = cursor.execute('pragma user_version').fetchone()[0]
+        for target, script in enumerate(MIGRATIONS[version:], version + 1):
+            log.info("Migrating log database to version %d...", target)
+            try:
+                cursor.executescript('BEGIN;\n' + script + '\nPRAGMA user_version = {};\nCOMMIT;'.format(target))
+            except sqlite3.Error:
+                if self.logdb.in_transaction:
+                    self.logdb.rollback() # leaves the database at the previous version
+                log.error("Migration to version %d failed and was rolled back", target)
+                raise
+        if version < 3:
+            # Messages logged from now on are counted by the log writer
+            cursor.execute("INSERT OR IGNORE INTO backfills(name, done, last) SELECT 'rollups', 0, coalesce(max(id), 0) FROM messages")
             self.logdb.commit()
+
+    def maintain(self, full=False, chunk=1024):
+        """Reclaims free pages, refreshes query planner statistics and checkpoints the WAL.
+
+        Runs on its own connection and commits after every chunk of pages, so the log writer is
+        never locked out for long. A full maintenance run rebuilds the whole database with VACUUM,
+        which is needed once to switch databases created before WAL mode to incremental auto-vacuum.
+        """
+        def size():
+            return sum(os.path.getsize(f) for f in ('logs.db', 'logs.db-wal') if os.path.isfile(f))
+        start = time.monotonic()
+        before = size()
+        db = sqlite3.connect('logs.db', isolation_level=None)
+        page_size = db.execute('pragma page_size').fetchone()[0]
+        freed = 0
+        if full or db.execute('pragma auto_vacuum').fetchone()[0] != 2:
+            if full:
+                freed = db.execute('pragma freelist_count').fetchone()[0]
+                db.execute('pragma auto_vacuum=INCREMENTAL')
+                db.execute('vacuum')
         else:
-            self.logdb = sqlite3.connect('logs.db')
-            cursor = self.logdb.cursor()
-            cursor.execute('pragma foreign_keys=ON')
-            cursor.execute('''
-                CREATE TABLE messages(
-                    id INTEGER NOT NULL PRIMARY KEY,
-                    guild INTEGER,
-                    channel INTEGER NOT NULL,
-                    message INTEGER NOT NULL,
-                    user INTEGER NOT NULL,
-                    text TEXT NOT NULL,
-                    time INTEGER NOT NULL,
-                    type TINYINT NOT NULL CHECK (type IN (0,1)),
-                    FOREIGN KEY(guild) REFERENCES guilds(guild),
-                    FOREIGN KEY(channel) REFERENCES channels(channel),
-                    FOREIGN KEY(user) REFERENCES users(user))
-            ''') # type: 0 (created), 1 (edited)
-            cursor.execute('''
-                CREATE TABLE guilds(
-                    guild INTEGER NOT NULL PRIMARY KEY,
-                    name TEXT NOT NULL)
-            ''')
+            while True:
+                free = db.execute('pragma freelist_count').fetchone()[0]
+                if free == 0:
+                    break
+                db.execute('pragma incremental_vacuum({})'.format(min(free, chunk)))
+                freed += free - db.execute('pragma freelist_count').fetchone()[0]
+        db.execute('pragma analysis_limit=1000')
+        db.execute('analyze')
+        db.execute('pragma wal_checkpoint(TRUNCATE)')
+        auto_vacuum = db.execute('pragma auto_vacuum').fetchone()[0]
+        db.close()
+        return {'elapsed': time.monotonic() - start,
+                'freed': freed * page_size,
+                'before': before,
+                'after': size(),
+                'incremental': auto_vacuum == 2}
+
+    def rebuild_rollups(self, chunk=100000):
+        """Recomputes the rollups table from messages, chunk messages per transaction.
+
+        Messages logged while this runs are counted by the log writer as usual: the old rollups are
+        dropped in the same transaction that fixes the last message id covered by the rebuild.
+        """
+        start = time.monotonic()
+        db = sqlite3.connect('logs.db', isolation_level=None)
+        db.execute('BEGIN IMMEDIATE')
+        db.execute('DELETE FROM rollups')
+        last = db.execute('SELECT max(id) FROM messages').fetchone()[0] or 0
+        db.execute("UPDATE backfills SET done = last WHERE name = 'rollups'") # this rebuild covers whatever the backfill had left
+        db.execute('COMMIT')
+        for low in range(0, last, chunk):
+            db.execute('''
+                INSERT INTO rollups(guild, channel, user, type, hour, messages, words, first)
+                SELECT guild, channel, user, type, time / 3600, count(*), sum(length(text) - length(replace(text, ' ', '')) + 1), min(time) FROM messages
+                WHERE id > ? AND id <= ? AND guild IS NOT NULL
+                GROUP BY guild, channel, user, type, time / 3600
+                ON CONFLICT(guild, channel, user, type, hour) DO UPDATE SET
+                messages=messages+excluded.messages, words=words+excluded.words, first=min(first, excluded.first)
+            ''', (low, min(low + chunk, last)))
+        rows = db.execute('SELECT count(*) FROM rollups').fetchone()[0]
+        db.close()
+        self.results.clear()
+        return (rows, time.monotonic() - start)
+
+    def backfill_rollups(self, chunk=20000, pause=0.05):
+        """Counts messages logged before the rollups existed into them, chunk messages per transaction, until done or stopping is set."""
+        db = sqlite3.connect('logs.db', isolation_level=None)
+        row = db.execute("SELECT done, last FROM backfills WHERE name = 'rollups'").fetchone()
+        if row and row[0] < row[1]:
+            log.info("Counting %d messages for stats, topusers and topchans...", row[1] - row[0])
+        while row and row[0] < row[1] and not self.stopping.is_set():
+            db.execute('BEGIN IMMEDIATE')
+            done, last = db.execute("SELECT done, last FROM backfills WHERE name = 'rollups'").fetchone() # rebuild_rollups may have finished it
+            upto = min(done + chunk, last)
+            if done < last:
+                db.execute('''
+                    INSERT INTO rollups(guild, channel, user, type, hour, messages, words, first)
+                    SELECT guild, channel, user, type, time / 3600, count(*), sum(length(text) - length(replace(text, ' ', '')) + 1), min(time) FROM messages
+                    WHERE id > ? AND id <= ? AND guild IS NOT NULL
+                    GROUP BY guild, channel, user, type, time / 3600
+                    ON CONFLICT(guild, channel, user, type, hour) DO UPDATE SET
+                    messages=messages+excluded.messages, words=words+excluded.words, first=min(first, excluded.first)
+                ''', (done, upto))
+                db.execute("UPDATE backfills SET done = ? WHERE name = 'rollups'", (upto,))
+            db.execute('COMMIT')
+            self.results.clear()
+            row = (upto, last)
+            self.stopping.wait(pause) # let the log writer in between chunks
+        db.close()
+
+    def backfill_fts(self, chunk=5000, pause=0.05):
+        """Indexes messages logged before the full-text index existed, chunk messages per transaction, until done or stopping is set."""
+        db = sqlite3.connect('logs.db', isolation_level=None)
+        done, last = db.execute("SELECT done, last FROM backfills WHERE name = 'messages_fts'").fetchone()
+        if done < last:
+            log.info("Indexing %d messages for search...", last - done)
+        while done < last and not self.stopping.is_set():
+            upto = min(done + chunk, last)
+            db.execute('BEGIN IMMEDIATE')
+            db.execute('INSERT INTO messages_fts(rowid, text) SELECT id, text FROM messages WHERE id > ? AND id <= ?', (done, upto))
+            db.execute("UPDATE backfills SET done = ? WHERE name = 'messages_fts'", (upto,))
+            db.execute('COMMIT')
+            done = upto
+            self.stopping.wait(pause) # let the log writer in between chunks
+        db.close()
+
+    def search(self, query, guild=None, channel=None, user=None, after=None, before=None, limit=10, offset=0):
+        """Returns (time, channel, name, snippet) for messages matching the FTS5 query, best match first. Meant to be run in query_pool."""
+        clauses = ['messages_fts MATCH ?']
+        params = [query]
+        for clause, value in (('m.guild = ?', guild), ('m.channel = ?', channel), ('m.user = ?', user), ('m.time >= ?', after), ('m.time < ?', before)):
+            if value is not None:
+                clauses.append(clause)
+                params.append(value)
+        cursor = self.reader().cursor()
+        cursor.execute('''
+            SELECT datetime(m.time, 'unixepoch'), c.name, CASE WHEN n.nick IS NULL THEN u.name ELSE n.nick END as name, snippet(messages_fts, 0, '**', '**', '...', 16) FROM messages_fts
+            INNER JOIN messages AS m ON m.id = messages_fts.rowid
+            INNER JOIN channels AS c ON m.channel = c.channel
+            INNER JOIN users AS u ON m.user = u.user
+            LEFT JOIN nicks AS n ON m.guild = n.guild AND m.user = n.user
+            WHERE {}
+            ORDER BY rank
+            LIMIT ? OFFSET ?
+        '''.format(' AND '.join(clauses)), params + [limit, offset])
+        return cursor.fetchall()
+
+    def last_seen(self, user):
+        """Returns (timestamp, guild, channel, name, text, type) for the user's latest logged guild message, or None."""
+        cursor = self.logdb.cursor()
+        cursor.execute('''
+            SELECT datetime(m.time, 'unixepoch') as timestamp, g.name as guild, c.name as channel, CASE WHEN n.nick IS NULL THEN u.name ELSE n.nick END as name, m.text, m.type FROM messages AS m
+            INNER JOIN guilds AS g ON m.guild = g.guild
+            INNER JOIN channels AS c ON m.channel = c.channel
+            INNER JOIN users AS u ON m.user = u.user
+            INNER JOIN nicks AS n ON m.guild = n.guild AND m.user = n.user
+            WHERE m.guild IS NOT NULL AND m.user = ?
+            ORDER BY m.time DESC
+            LIMIT 1
+        ''', (user,))
+        return cursor.fetchone()
+
+    def guild_names(self, guild, db=None):
+        cursor = (db or self.logdb).cursor()
+        cursor.execute('''
+            SELECT u.user, CASE WHEN n.nick IS NULL THEN u.name ELSE n.nick END as name FROM nicks AS n
+            INNER JOIN users AS u ON n.user = u.user
+            WHERE n.guild = ?
+        ''', (guild.id,))
+        return Names(self.client, guild, cursor.fetchall())
+
+    def stamp(self, guild):
+        """Returns a messages.id that covers all of the guild's logged messages and only changes when one is logged."""
+        return self.logwriter.stamp(guild)
+
+    def rollup_filter(self, guild, channel=None, user=None, type=None):
+        clauses = ['guild = ?']
+        params = [guild]
+        for column, value in (('channel', channel), ('user', user), ('type', type)):
+            if value is not None:
+                clauses.append('{} = ?'.format(column))
+                params.append(value)
+        return (' AND '.join(clauses), params)
+
+    USER_ORDERS = {
+        'messages': 't.messages',
+        'words': 't.words * 1.0 / t.messages',
+        'rate': "t.messages * 1.0 / (CAST(strftime('%s', 'now') AS INTEGER) - t.first + 1)",
+    }
+
+    def user_totals(self, guild, channel=None, user=None, type=None, order='messages', limit=None):
+        """Returns (user, name, messages, words, earliest time) for each user, sorted by one of USER_ORDERS. Meant to be run in query_pool."""
+        def compute():
+            columns = self.columns and self.columns.get(guild)
+            if columns:
+                names = self.column_names(guild)
+                return [(row[0], names[row[0]]) + row[1:] for row in columns.user_totals(channel, user, type, order, limit)]
+            where, params = self.rollup_filter(guild, channel, user, type)
+            cursor = self.reader().cursor()
             cursor.execute('''
-                CREATE TABLE channels(
-                    channel INTEGER NOT NULL PRIMARY KEY,
-                    guild INTEGER,
-                    name TEXT NOT NULL,
-                    FOREIGN KEY(guild) REFERENCES guilds(guild))
-            ''')
+                SELECT t.user, CASE WHEN n.nick IS NULL THEN u.name ELSE n.nick END as name, t.messages, t.words, t.first FROM (
+                    SELECT user, sum(messages) AS messages, sum(words) AS words, min(first) AS first FROM rollups
+                    WHERE {}
+                    GROUP BY user
+                ) AS t
+                INNER JOIN users AS u ON t.user = u.user
+                LEFT JOIN nicks AS n ON n.guild = ? AND n.user = t.user
+                ORDER BY {} DESC
+                LIMIT ?
+            '''.format(where, self.USER_ORDERS[order]), params + [guild, -1 if limit is None else limit])
+            return cursor.fetchall()
+        return self.results.fetch(('user_totals', guild, channel, user, type, order, limit), self.stamp(guild), compute)
+
+    def rollup_summary(self, guild, channel=None, user=None, type=None):
+        """Returns (users, messages, words) summed over the matching rollups. Meant to be run in query_pool."""
+        def compute():
+            columns = self.columns and self.columns.get(guild)
+            if columns:
+                return columns.summary(channel, user, type)
+            where, params = self.rollup_filter(guild, channel, user, type)
+            cursor = self.reader().cursor()
             cursor.execute('''
-                CREATE TABLE users(
-                    user INTEGER NOT NULL PRIMARY KEY,
-                    name TEXT NOT NULL)
-            ''')
+                SELECT count(DISTINCT user), ifnull(sum(messages), 0), ifnull(sum(words), 0) FROM rollups
+                WHERE {}
+            '''.format(where), params)
+            return cursor.fetchone()
+        return self.results.fetch(('rollup_summary', guild, channel, user, type), self.stamp(guild), compute)
+
+    def channel_totals(self, guild, user=None):
+        """Returns (channel, name, messages) for each channel, most messages first. Meant to be run in query_pool."""
+        def compute():
+            columns = self.columns and self.columns.get(guild)
+            if columns:
+                names = dict(self.reader().execute('SELECT channel, name FROM channels WHERE guild = ?', (guild,)))
+                return [(channel, names.get(channel, str(channel)), messages) for channel, messages in columns.channel_totals(user)]
+            where, params = self.rollup_filter(guild, user=user, type=0)
+            cursor = self.reader().cursor()
             cursor.execute('''
-                CREATE TABLE nicks(
-                    guild INTEGER NOT NULL,
-                    user INTEGER NOT NULL,
-                    nick TEXT,
-                    PRIMARY KEY(guild, user),
-                    FOREIGN KEY(guild) REFERENCES guilds(guild),
-                    FOREIGN KEY(user) REFERENCES users(user))
-            ''')
+                SELECT t.channel, c.name, t.messages FROM (
+                    SELECT channel, sum(messages) AS messages FROM rollups
+                    WHERE {}
+                    GROUP BY channel
+                ) AS t
+                INNER JOIN channels AS c ON t.channel = c.channel
+                ORDER BY t.messages DESC
+            '''.format(where), params)
+            return cursor.fetchall()
+        return self.results.fetch(('channel_totals', guild, user), self.stamp(guild), compute)
+
+    def hour_totals(self, guild, channel=None, user=None):
+        """Returns the number of messages sent in each hour of the day (UTC). Meant to be run in query_pool."""
+        def compute():
+            columns = self.columns and self.columns.get(guild)
+            if columns:
+                return columns.hour_totals(channel, user)
+            where, params = self.rollup_filter(guild, channel, user, type=0)
+            cursor = self.reader().cursor()
             cursor.execute('''
-                CREATE VIEW log AS
-                SELECT time, timestamp, guild, channel, name, text, CASE type WHEN 0 THEN 'CREATE' ELSE 'EDIT' END AS type FROM (
-                    SELECT m.time, datetime(m.time, 'unixepoch') as timestamp, g.name as guild, c.name as channel, CASE WHEN n.nick IS NULL THEN u.name ELSE n.nick END as name, m.text, m.type FROM messages AS m
-                    INNER JOIN guilds AS g ON m.guild = g.guild
-                    INNER JOIN channels AS c ON m.channel = c.channel
-                    INNER JOIN users AS u ON m.user = u.user
-                    INNER JOIN nicks AS n ON m.guild = n.guild AND m.user = n.user
-                    WHERE m.guild IS NOT NULL
-                    UNION
-                    SELECT m.time, datetime(m.time, 'unixepoch') as timestamp, NULL as guild, c.name as channel, u.name as name, m.text, m.type FROM messages AS m
-                    INNER JOIN channels AS c ON m.channel = c.channel
-                    INNER JOIN users AS u ON m.user = u.user
-                    WHERE m.guild IS NULL
-                ) ORDER BY time
-            ''')
-            self.logdb.commit()
+                SELECT hour % 24, sum(messages) FROM rollups
+                WHERE {}
+                GROUP BY hour % 24
+            '''.format(where), params)
+            hours = [0] * 24
+            for hour, count in cursor:
+                hours[hour] = count
+            return hours
+        return self.results.fetch(('hour_totals', guild, channel, user), self.stamp(guild), compute)
+
+    def conversation_graph(self, guild, channel=None):
+        """Returns (messages, {(user, user): weight}) counting users speaking directly after each other or mentioning each other.
+
+        Meant to be run in query_pool. Messages are streamed in chunks of analytics_chunk rows, so
+        peak memory is O(analytics_chunk + users²) however long the history is. Results are cached,
+        and only messages logged since are read on the next call.
+        """
+        columns = self.columns and self.columns.get(guild)
+        if columns:
+            pairs = columns.conversations(channel)
+            return pairs.messages, pairs.counts
+        import analytics
+        db = self.reader()
+        stamp = self.stamp(guild)
+        count = functools.partial(self.count_conversations, db, guild, channel, upto=stamp)
+        pairs = self.results.fetch(('stats', guild, channel), stamp,
+                                   lambda: count(analytics.PairCounter(), 0), lambda cached, since: count(cached.copy(), since))
+        return pairs.messages, dict(pairs.counts)
+
+    async def load_columns(self, guild):
+        """Loads the guild into the column store, if it is enabled and the guild isn't loaded already."""
+        if self.columns is None or self.columns.get(guild) is not None:
+            return
+        if guild not in self.column_loads:
+            self.columns.begin_load(guild)
+            self.column_loads[guild] = self.client.loop.run_in_executor(self.query_pool, self.read_columns, guild)
+            self.column_loads[guild].add_done_callback(lambda future: self.column_loads.pop(guild, None))
+        await asyncio.shield(self.column_loads[guild])
+
+    def read_columns(self, guild):
+        """Reads the guild's messages into the column store. Meant to be run in query_pool."""
+        import analytics
+        db = self.reader()
+        try:
+            columns = analytics.GuildColumns()
+            chunk = self.conf.get('analytics_chunk', 65536)
+            db.execute('BEGIN') # messages and mentions from the same snapshot
+            last = db.execute('SELECT coalesce(max(id), 0) FROM messages').fetchone()[0]
+            cursor = db.execute('''
+                SELECT message, time, channel, user, type, length(text) - length(replace(text, ' ', '')) + 1 FROM messages
+                WHERE guild = ?
+                ORDER BY id
+            ''', (guild,))
+            for rows in iter(functools.partial(cursor.fetchmany, chunk), []):
+                columns.append(rows)
+            cursor = db.execute("SELECT time, channel, user, text FROM messages WHERE guild = ? AND type = 0 AND text LIKE '%<@%' ORDER BY id", (guild,))
+            for rows in iter(functools.partial(cursor.fetchmany, chunk), []):
+                columns.append_mentions([(timestamp, channel, user, int(mentioned)) for timestamp, channel, user, text in rows for mentioned in MENTION_REGEX.findall(text)])
+        except:
+            self.columns.abort_load(guild)
+            raise
+        finally:
+            db.rollback()
+        self.columns.finish_load(guild, columns, last)
+
+    def columns_logged(self, messages):
+        """Adds committed (id, messages row) pairs to the column store. Called from the log writer thread."""
+        if self.columns is None:
+            return
+        for id, (guild, channel, message, user, text, timestamp, type) in messages:
+            if guild is not None:
+                mentions = [(timestamp, channel, user, int(mentioned)) for mentioned in MENTION_REGEX.findall(text)] if type == 0 else []
+                self.columns.append(guild, id, (message, timestamp, channel, user, type, len(text.split(' '))), mentions)
+
+    def column_names(self, guild):
+        """Returns the guild's Names, for use in query_pool."""
+        return self.guild_names(self.client.get_guild(guild) or discord.Object(guild), self.reader())
+
+    def count_conversations(self, db, guild, channel, pairs, since, upto):
+        """Adds the messages with since < id <= upto to the analytics.PairCounter pairs and returns it."""
+        import analytics
+        where, params = self.rollup_filter(guild, channel, type=0)
+        where += ' AND id > ? AND id <= ?'
+        params += [since, upto]
+        for columns in analytics.chunks(db.execute('SELECT time, user FROM messages WHERE {} ORDER BY time ASC'.format(where), params), 2, self.conf.get('analytics_chunk', 65536)):
+            pairs.add(columns[:, 1])
+        for user, text in db.execute("SELECT user, text FROM messages WHERE {} AND text LIKE '%<@%'".format(where), params):
+            for match in MENTION_REGEX.finditer(text):
+                pairs.add_pair(user, int(match.group(1)))
+        return pairs
 
     def cmd(self, description, *aliases, guild=True, pm=True):
         def decorator(func):
@@ -120,206 +616,246 @@ class SelfBot:
                 if alias not in self.commands:
                     self.commands[alias] = [func, "```\nAlias for {0}{1}.```".format(self.conf['prefix'], name), [guild, pm]]
                 else:
-                    print("ERROR: Cannot assign alias {0} to command {1} since it is already the name of a command!".format(alias, name))
+                    log.error("Cannot assign alias %s to command %s since it is already the name of a command!", alias, name)
             return func
         return decorator
 
+    def schedule(self, schid, due, message, commandstring, recursion, interval=None, persist=True):
+        self.scheduler[schid] = [due, message, commandstring, recursion, interval]
+        heapq.heappush(self.schedule_heap, (due, schid))
+        if persist:
+            self.logdb.execute('''
+                INSERT OR REPLACE INTO schedule(id, due, channel, message, command, recursion, interval) VALUES(?,?,?,?,?,?,?)
+            ''', (schid, due.timestamp(), message.channel.id, message.id, commandstring, recursion, interval.total_seconds() if interval else None))
+            self.logdb.commit()
+        self.schedule_wakeup.set()
+
+    def unschedule(self, schid):
+        del self.scheduler[schid] # its heap entry is dropped once it comes up
+        self.logdb.execute('DELETE FROM schedule WHERE id = ?', (schid,))
+        self.logdb.commit()
+
+    async def load_schedule(self):
+        """Schedules the persisted jobs that aren't scheduled yet. Jobs whose message is gone are dropped; any other failure leaves them for the next call."""
+        cursor = self.logdb.cursor()
+        cursor.execute('SELECT id, due, channel, message, command, recursion, interval FROM schedule')
+        for schid, due, channel, message, commandstring, recursion, interval in cursor.fetchall():
+            if schid in self.scheduler:
+                continue
+            try:
+                target = self.client.get_channel(channel) or await self.client.fetch_channel(channel)
+                message = await target.fetch_message(message)
+            except (discord.NotFound, discord.Forbidden):
+                log.info("Dropping scheduled command with id %d, its message is gone", schid)
+                self.logdb.execute('DELETE FROM schedule WHERE id = ?', (schid,))
+                continue
+            except discord.HTTPException as e:
+                log.warning("Could not load scheduled command with id %d, retrying on the next reconnect: %s", schid, e)
+                continue
+            interval = datetime.timedelta(seconds=interval) if interval else None
+            self.schedule(schid, datetime.datetime.fromtimestamp(due), message, commandstring, recursion, interval, persist=False)
+        self.logdb.commit()
+
+    async def run_scheduled(self, schid):
+        if schid not in self.scheduler:
+            return
+        due, message, command_string, recursion, interval = self.scheduler[schid]
+        if interval:
+            now = datetime.datetime.now()
+            while due <= now:
+                due += interval
+            self.schedule(schid, due, message, command_string, recursion, interval)
+        else:
+            self.unschedule(schid)
+        async with self.scheduler_slots:
+            log.info("Executing scheduled command with id %d", schid)
+            command, _, parameters = command_string.partition(' ')
+            await self.parse_command(message, command, parameters, recursion)
+
     async def scheduler_loop(self):
         while not self.client.is_closed():
-            for i in list(self.scheduler):
-                if self.scheduler[i][0] < datetime.datetime.now():
-                    scheduler_array = self.scheduler[i][:]
-                    del self.scheduler[i]
-                    command_string = scheduler_array[2]
-                    print("Executing scheduled command with id {}".format(i))
-                    command = command_string.split(' ')[0]
-                    parameters = ' '.join(command_string.split(' ')[1:])
-                    await self.parse_command(scheduler_array[1], command, parameters, scheduler_array[3])
-            await asyncio.sleep(0.1)
-        print("Scheduler exiting...")
+            heap = self.schedule_heap
+            while heap and (heap[0][1] not in self.scheduler or self.scheduler[heap[0][1]][0] != heap[0][0]):
+                heapq.heappop(heap) # removed or rescheduled since it was pushed
+            now = datetime.datetime.now()
+            if heap and heap[0][0] <= now:
+                due, schid = heapq.heappop(heap)
+                self.client.loop.create_task(self.run_scheduled(schid))
+                continue
+            self.schedule_wakeup.clear()
+            try:
+                await asyncio.wait_for(self.schedule_wakeup.wait(), (heap[0][0] - now).total_seconds() if heap else None)
+            except asyncio.TimeoutError:
+                pass
+        log.info("Scheduler exiting...")
+
+    def log_failure(self, future):
+        """Done callback for background futures nobody awaits: logs whatever they raised."""
+        if not future.cancelled() and future.exception() is not None:
+            log.error("Background task failed", exc_info=future.exception())
 
     def run(self):
-        print("Starting...")
+        log.info("Starting...")
 
         self.load()
                     
         self.client.loop.create_task(self.scheduler_loop())
+        for backfill in (self.backfill_fts, self.backfill_rollups):
+            self.client.loop.run_in_executor(None, backfill).add_done_callback(self.log_failure)
+        self.start_render_pool()
+        self.lag = LagMonitor(self.client.loop, self.conf.get('lag_interval', 0.25), self.conf.get('lag_threshold', 0.1))
+        self.lag.start(self.conf.get('slow_callbacks', False))
+        self.register_events()
+
+        try:
+            self.client.run(self.conf['token'], bot=False)
+        finally:
+            self.stopping.set()
+            self.logwriter.stop()
+            for pool in list(self.render_pools):
+                pool.shutdown(wait=False, cancel_futures=True)
+            self.log_listener.stop()
 
+    def register_events(self):
         @self.client.event
         async def on_ready():
             await self.client.change_presence(status=discord.Status.invisible)
-            print('Logged in as')
-            print(self.client.user.name+"#"+self.client.user.discriminator)
-            print(self.client.user.id)
-            print('------')
+            log.info("Logged in as %s#%s (%d)", self.client.user.name, self.client.user.discriminator, self.client.user.id)
+            await self.load_schedule()
 
         @self.client.event
         async def on_message(message):
-            cursor = self.logdb.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO users(user, name) VALUES(?,?)
-            ''', (
-                message.author.id,
-                message.author.name
-            ))
-            if isinstance(message.channel, discord.TextChannel):
-                print("[{0.created_at}] [{0.guild.name}/{0.channel.name}] <{0.author.display_name}> {0.clean_content}".format(message))
-                cursor.execute('''
-                    INSERT OR REPLACE INTO guilds(guild, name) VALUES(?,?)
-                ''', (
-                    message.guild.id,
-                    message.guild.name
-                ))
-                try:
-                    cursor.execute('''
-                        INSERT OR REPLACE INTO nicks(guild, user, nick) VALUES(?,?,?)
-                    ''', (
-                        message.guild.id,
-                        message.author.id,
-                        message.guild.get_member(message.author.id).nick
-                    ))
-                except:
-                    pass
-                cursor.execute('''
-                    INSERT OR REPLACE INTO channels(channel, guild, name) VALUES(?,?,?)
-                ''', (
-                    message.channel.id,
-                    message.channel.guild.id,
-                    message.channel.name
-                ))
-                cursor.execute('''
-                    INSERT INTO messages(guild, channel, message, user, text, time, type) VALUES(?,?,?,?,?,?,?)
-                ''', (
-                    message.guild.id if message.guild else None,
-                    message.channel.id,
-                    message.id,
-                    message.author.id,
-                    message.content + ' ' + ' '.join(a.url for a in message.attachments),
-                    int(time.mktime(message.created_at.timetuple())),
-                    0
-                ))
-            else:
-                if isinstance(message.channel, discord.DMChannel):
-                    print("[{0.created_at}] [{0.channel.recipient.name}#{0.channel.recipient.discriminator}] <{0.author.display_name}> {0.clean_content}".format(message))
-                    cursor.execute('''
-                        INSERT OR REPLACE INTO channels(channel, guild, name) VALUES(?,?,?)
-                    ''', (
-                        message.channel.id,
-                        None,
-                        message.channel.recipient.name+'#'+message.channel.recipient.discriminator
-                    ))
+            logger = self.message_logger(message)
+            if logger.isEnabledFor(logging.INFO):
+                if isinstance(message.channel, discord.TextChannel):
+                    logger.info("[%s] [%s/%s] <%s> %s", message.created_at, message.guild.name, message.channel.name, message.author.display_name, message.clean_content)
+                elif isinstance(message.channel, discord.DMChannel):
+                    logger.info("[%s] [%s#%s] <%s> %s", message.created_at, message.channel.recipient.name, message.channel.recipient.discriminator, message.author.display_name, message.clean_content)
                 else: #isinstance(message.channel, discord.GroupChannel)
-                    print("[{0.created_at}] [{0.channel.name}] <{0.author.display_name}> {0.clean_content}".format(message))
-                    cursor.execute('''
-                        INSERT OR REPLACE INTO channels(channel, guild, name) VALUES(?,?,?)
-                    ''', (
-                        message.channel.id,
-                        None,
-                        message.channel.name
-                    ))
-                cursor.execute('''
-                    INSERT INTO messages(guild, channel, message, user, text, time, type) VALUES(?,?,?,?,?,?,?)
-                ''', (
-                    None,
-                    message.channel.id,
-                    message.id,
-                    message.author.id,
-                    message.content + ' ' + ' '.join(a.url for a in message.attachments),
-                    int(time.mktime(message.created_at.timetuple())),
-                    0
-                ))
-            self.logdb.commit()
+                    logger.info("[%s] [%s] <%s> %s", message.created_at, message.channel.name, message.author.display_name, message.clean_content)
+            self.log_message(message, int(time.mktime(message.created_at.timetuple())), 0)
 
             if not message.author.id == self.client.user.id:
                 return
             if message.content.startswith(self.conf['prefix']):
-                print('Command: ' + message.content)
+                log.info("Command: %s", message.content)
             else:
                 return
-            command = message.content[len(self.conf['prefix']):].strip().split(' ')[0].lower()
-            parameters = ' '.join(message.content.strip().split(' ')[1:])
-            await self.parse_command(message, command, parameters)
+            command, _, parameters = message.content[len(self.conf['prefix']):].strip().partition(' ')
+            await self.parse_command(message, command.lower(), parameters)
+
+        @self.client.event
+        async def on_raw_message_delete(payload):
+            for future in self.renders.get(payload.message_id, ()):
+                future.cancel()
 
         @self.client.event
         async def on_message_edit(before, after):
-            cursor = self.logdb.cursor()
-            cursor.execute('''
-                INSERT OR REPLACE INTO users(user, name) VALUES(?,?)
-            ''', (
-                after.author.id,
-                after.author.name
-            ))
-            if isinstance(after.channel, discord.TextChannel):
-                cursor.execute('''
-                    INSERT OR REPLACE INTO guilds(guild, name) VALUES(?,?)
-                ''', (
-                    after.guild.id,
-                    after.guild.name
-                ))
-                try:
-                    cursor.execute('''
-                        INSERT OR REPLACE INTO nicks(guild, user, nick) VALUES(?,?,?)
-                    ''', (
-                        after.guild.id,
-                        after.author.id,
-                        after.guild.get_member(after.author.id).nick
-                    ))
-                except:
-                    pass
-                cursor.execute('''
-                    INSERT OR REPLACE INTO channels(channel, guild, name) VALUES(?,?,?)
-                ''', (
-                    after.channel.id,
-                    after.channel.guild.id,
-                    after.channel.name
-                ))
-                cursor.execute('''
-                    INSERT INTO messages(guild, channel, message, user, text, time, type) VALUES(?,?,?,?,?,?,?)
-                ''', (
-                    after.guild.id if after.guild else None,
-                    after.channel.id,
-                    after.id,
-                    after.author.id,
-                    after.content + ' ' + ' '.join(a.url for a in after.attachments),
-                    int(time.mktime(before.edited_at.timetuple() if before.edited_at else after.created_at.timetuple())),
-                    1
-                ))
+            self.log_message(after, int(time.mktime(before.edited_at.timetuple() if before.edited_at else after.created_at.timetuple())), 1)
+
+    def start_render_pool(self):
+        """Starts render_workers workers, each a single-process pool that runs one render at a time."""
+        self.render_idle = asyncio.Queue()
+        for _ in range(self.conf.get('render_workers', 2)):
+            self.add_render_worker()
+
+    def add_render_worker(self):
+        """Starts a worker in the background and makes it available to render once it's up.
+
+        If it can't start, its place in the idle queue holds the exception instead, to be raised by
+        the render that takes it, which also tries to start the worker again.
+        """
+        def start():
+            pool = concurrent.futures.ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn'), initializer=render_init)
+            self.render_pools.add(pool)
+            try:
+                return (pool, pool.submit(os.getpid).result()) # also waits for the worker to import the plotting libraries
+            except:
+                pool.shutdown(wait=False)
+                self.render_pools.discard(pool)
+                raise
+        def started(future):
+            if future.cancelled() or future.exception() is not None:
+                self.log_failure(future)
+                self.render_idle.put_nowait(future.exception() or asyncio.CancelledError())
             else:
-                if isinstance(after.channel, discord.DMChannel):
-                    cursor.execute('''
-                        INSERT OR REPLACE INTO channels(channel, guild, name) VALUES(?,?,?)
-                    ''', (
-                        after.channel.id,
-                        None,
-                        after.channel.recipient.name+'#'+after.channel.recipient.discriminator
-                    ))
-                else: #isinstance(after.channel, discord.GroupChannel)
-                    cursor.execute('''
-                        INSERT OR REPLACE INTO channels(channel, guild, name) VALUES(?,?,?)
-                    ''', (
-                        after.channel.id,
-                        None,
-                        after.channel.name
-                    ))
-                cursor.execute('''
-                    INSERT INTO messages(guild, channel, message, user, text, time, type) VALUES(?,?,?,?,?,?,?)
-                ''', (
-                    None,
-                    after.channel.id,
-                    after.id,
-                    after.author.id,
-                    after.content + ' ' + ' '.join(a.url for a in after.attachments),
-                    int(time.mktime(before.edited_at.timetuple() if before.edited_at else after.created_at.timetuple())),
-                    1
-                ))
-            self.logdb.commit()
+                self.render_idle.put_nowait(future.result())
+        self.client.loop.run_in_executor(None, start).add_done_callback(started)
+
+    async def render(self, message, function, *args):
+        """Runs function(*args) on an idle render worker and returns the result.
+
+        Gives up once render_timeout seconds have passed, waiting for a worker included, and is
+        cancelled if message is deleted meanwhile. Either way the worker is killed, so the render
+        stops, and replaced; other renders carry on.
+        """
+        timeout = self.conf.get('render_timeout', 60)
+        deadline = self.client.loop.time() + timeout
+        worker = await asyncio.wait_for(self.render_idle.get(), timeout)
+        if isinstance(worker, BaseException): # the worker couldn't start
+            self.add_render_worker()
+            raise worker
+        pool, pid = worker
+        future = self.client.loop.run_in_executor(pool, function, *args)
+        self.renders.setdefault(message.id, set()).add(future)
+        try:
+            result = await asyncio.wait_for(future, max(0, deadline - self.client.loop.time()))
+        except (asyncio.TimeoutError, asyncio.CancelledError, concurrent.futures.BrokenExecutor):
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError: # it died by itself
+                pass
+            pool.shutdown(wait=False)
+            self.render_pools.discard(pool)
+            self.add_render_worker()
+            raise
+        except:
+            self.render_idle.put_nowait((pool, pid)) # the render failed, the worker is fine
+            raise
+        finally:
+            self.renders[message.id].discard(future)
+            if not self.renders[message.id]:
+                del self.renders[message.id]
+        self.render_idle.put_nowait((pool, pid))
+        return result
 
-        self.client.run(self.conf['token'], bot=False)
+    def log_message(self, message, timestamp, type):
+        self.log_dimension('users', message.author.id, message.author.name)
+        if isinstance(message.channel, discord.TextChannel):
+            self.log_dimension('guilds', message.guild.id, message.guild.name)
+            member = message.guild.get_member(message.author.id)
+            if member is not None:
+                self.log_dimension('nicks', (message.guild.id, message.author.id), member.nick)
+            self.log_dimension('channels', message.channel.id, (message.guild.id, message.channel.name))
+            guild = message.guild.id
+        else:
+            if isinstance(message.channel, discord.DMChannel):
+                name = message.channel.recipient.name+'#'+message.channel.recipient.discriminator
+            else: #isinstance(message.channel, discord.GroupChannel)
+                name = message.channel.name
+            self.log_dimension('channels', message.channel.id, (None, name))
+            guild = None
+        text = message.content + ' ' + ' '.join(a.url for a in message.attachments)
+        self.logwriter.put('messages', (
+            guild,
+            message.channel.id,
+            message.id,
+            message.author.id,
+            text,
+            timestamp,
+            type
+        ))
+
+    def log_dimension(self, table, key, value):
+        if self.dimcache.changed(table, key, value):
+            key = key if isinstance(key, tuple) else (key,)
+            value = value if isinstance(value, tuple) else (value,)
+            self.logwriter.put(table, key + value)
 
     async def parse_command(self, message, command, parameters, recursion=0):
-        print("Parsing command {} with parameters {}".format(command, parameters))
+        log.debug("Parsing command %s with parameters %s", command, parameters)
         if recursion >= MAX_RECURSION_DEPTH:
-            print("Hit max recursion depth of {}".format(MAX_RECURSION_DEPTH))
+            log.warning("Hit max recursion depth of %d", MAX_RECURSION_DEPTH)
             await self.reply(message, "ERROR: reached max recursion depth of {}".format(MAX_RECURSION_DEPTH), colour=discord.Colour.red(), footer=message.content.split()[0])
             return
         if isinstance(message.channel, discord.TextChannel):
@@ -336,25 +872,39 @@ class SelfBot:
             else:
                 try:
                     await self.commands[command][0](self, message, parameters, recursion=recursion)
+                except asyncio.CancelledError:
+                    log.info("Command %s was cancelled", command)
                 except:
-                    traceback.print_exc()
+                    log.exception("Error in command %s", command)
                     try:
                         await self.reply(message, "**Error in command:** {0}\n```py\n{1}```".format(message.content, traceback.format_exc()), colour=discord.Colour.red(), footer=message.content.split()[0])
                     except SystemExit:
                         raise
                     except Exception:
-                        print("Printing error message failed, wtf?")
+                        log.exception("Printing error message failed, wtf?")
         elif command in self.aliases:
-            aliased_command = self.aliases[command].split(' ')[0]
-            actual_params = ' '.join(self.aliases[command].split(' ')[1:]).format(parameters, *parameters.split(' '))
-            await self.parse_command(message, aliased_command, actual_params, recursion=recursion + 1)
+            try:
+                aliased_command, templates = self.alias_chain(command)
+            except ValueError as e:
+                await self.reply(message, "ERROR: {}".format(e), colour=discord.Colour.red(), footer=message.content.split()[0])
+                return
+            for template in templates[:MAX_RECURSION_DEPTH - recursion]:
+                parameters = template(parameters)
+            await self.parse_command(message, aliased_command, parameters, recursion=recursion + len(templates))
         else:
             await self.reply(message, "Invalid command.", colour=discord.Colour.red(), footer=message.content.split()[0])
 
-    async def reply(self, message, text, colour=discord.Colour.default(), footer="", title="", fields={}):
+    async def reply(self, message, text, colour=discord.Colour.default(), footer="", title="", fields={}, progress=False):
+        """Edits message into an embed showing text.
+
+        Progress replies are coalesced: at most one edit per reply_interval seconds is sent for a
+        message, showing the latest progress. Any other reply drops pending progress and is sent at once.
+        """
+        state = self.replies.get(message.id)
         embed = None
-        if message.embeds:
-            embed = copy.deepcopy(message.embeds[0])
+        base = state['embed'] if state else (message.embeds[0] if message.embeds else None)
+        if base:
+            embed = copy.deepcopy(base)
             if title:
                 embed.title = title
             embed.description = text
@@ -367,7 +917,28 @@ class SelfBot:
         embed.clear_fields()
         for field in fields.items():
             embed.add_field(name=field[0], value=field[1])
-        await message.edit(content='', embed=embed)
+        if not progress:
+            if state:
+                del self.replies[message.id]
+                state['task'].cancel()
+            await message.edit(content='', embed=embed)
+        elif state:
+            state['embed'] = embed
+            state['pending'] = True
+        else:
+            state = self.replies[message.id] = {'embed': embed, 'pending': True}
+            state['task'] = self.client.loop.create_task(self.send_progress(message, state))
+
+    async def send_progress(self, message, state):
+        """Sends the latest pending progress reply to message, once per reply_interval, until there is none left."""
+        try:
+            while state['pending']:
+                state['pending'] = False
+                await message.edit(content='', embed=state['embed'])
+                await asyncio.sleep(self.conf.get('reply_interval', 1.5))
+        finally:
+            if self.replies.get(message.id) is state:
+                del self.replies[message.id]
 
     async def _async(self, message, parameters, recursion=0):
         if parameters == '':
@@ -436,31 +1007,540 @@ class SelfBot:
             sys.stdout = old_stdout
         return result
 
-    async def _query(self, message, parameters, recursion=0):
+    async def _query(self, message, parameters, recursion=0, explain=False):
         if parameters == '':
-            return (self.commands['longquery'][1].format(message.clean_content.split(' ', 1)[0]), 3)
-        cursor = bot.logdb.cursor()
+            return (self.commands['explain' if explain else 'longquery'][1].format(message.clean_content.split(' ', 1)[0]), 3)
+        if explain:
+            parameters = 'EXPLAIN QUERY PLAN ' + parameters
         result = None
         try:
-            cursor.execute(parameters)
-            rows = list(cursor.fetchall())
-            if len(rows) > 0:
-                output = '\t\t'.join(d[0] for d in cursor.description) + '\n'
+            try:
+                description, rows, truncated = await self.client.loop.run_in_executor(self.query_pool, self.run_query, parameters)
+            except sqlite3.OperationalError as e:
+                # Nothing was written on the read-only connection, so it's safe to run the statement again
+                if 'readonly' not in str(e):
+                    raise
+                description, rows, truncated = await self.client.loop.run_in_executor(self.query_pool, functools.partial(self.run_query, parameters, readonly=False))
+            if explain:
+                depth = {0: -1}
+                output = ''
+                for node, parent, _, detail in rows:
+                    depth[node] = depth.get(parent, -1) + 1
+                    output += '  ' * depth[node] + detail + '\n'
+                result = (output, 0)
+            elif len(rows) > 0:
+                output = '\t\t'.join(d[0] for d in description) + '\n'
                 output += '\n'.join(repr(row) for row in rows)
+                if truncated:
+                    output += '\n(stopped after {} rows)'.format(len(rows))
                 result = (output, 0)
             else:
                 result = (None, 1)
-            bot.logdb.commit()
-        except bot.logdb.Error:
+        except sqlite3.OperationalError as e:
+            if str(e) == 'interrupted':
+                result = ("Query took longer than {}s and was aborted.".format(self.conf.get('query_timeout', 30)), 2)
+            else:
+                result = (str(traceback.format_exc()), 2)
+        except sqlite3.Error:
             result = (str(traceback.format_exc()), 2)
         return result
 
-    async def _shell(self, message, parameters, recursion=0):
+    def reader(self, readonly=True):
+        """Returns this thread's read-only (or autocommitting read-write) connection to the log database."""
+        name = 'db' if readonly else 'rwdb'
+        if not hasattr(self.readers, name):
+            if readonly:
+                setattr(self.readers, name, sqlite3.connect('file:logs.db?mode=ro', uri=True))
+            else:
+                db = sqlite3.connect('logs.db', isolation_level=None)
+                db.execute('pragma foreign_keys=ON')
+                setattr(self.readers, name, db)
+        return getattr(self.readers, name)
+
+    def run_query(self, query, params=(), limit=None, timeout=None, readonly=True):
+        """Runs query and returns (description, rows, truncated).
+
+        Meant to be run in query_pool. The query is aborted once it has run for timeout seconds and
+        at most limit rows are fetched.
+        """
+        limit = limit or self.conf.get('query_row_limit', 1000)
+        timeout = timeout or self.conf.get('query_timeout', 30)
+        db = self.reader(readonly)
+        start = time.monotonic()
+        db.set_progress_handler(lambda: time.monotonic() - start > timeout, 10000)
+        try:
+            cursor = db.execute(query, params)
+            rows = []
+            while len(rows) < limit:
+                batch = cursor.fetchmany(min(500, limit - len(rows)))
+                if not batch:
+                    break
+                rows.extend(batch)
+            truncated = len(rows) == limit and cursor.fetchone() is not None
+            if not readonly:
+                # Whatever was written may have changed what cached analytics were computed from
+                self.results.clear()
+                if self.columns is not None:
+                    self.columns.clear()
+            return (cursor.description, rows, truncated)
+        finally:
+            db.set_progress_handler(None, 0)
+            elapsed = time.monotonic() - start
+            if elapsed > self.conf.get('slow_query_threshold', 1):
+                log.warning("Slow query (%.2fs): %s", elapsed, query)
+                self.slow_queries.append((datetime.datetime.now(), elapsed, query))
+
+    async def _shell(self, message, parameters, recursion=0, progress=None):
         if parameters == '':
             return ("", None)
-        with subprocess.Popen(["bash", "-c", parameters], stdout=subprocess.PIPE, stderr=subprocess.STDOUT) as p:
-            return (p.stdout.read(), p.wait())
+        process = await asyncio.create_subprocess_exec("bash", "-c", parameters, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, start_new_session=True)
+        jobid = max(self.shell_jobs, default=0) + 1
+        self.shell_jobs[jobid] = (parameters, process, datetime.datetime.now())
+        output = bytearray()
+        async def communicate():
+            last = 0
+            while True:
+                chunk = await process.stdout.read(4096)
+                if not chunk:
+                    break
+                output.extend(chunk)
+                if progress and time.monotonic() - last >= self.conf.get('shell_edit_interval', 2):
+                    last = time.monotonic()
+                    await progress(jobid, bytes(output))
+            return await process.wait() # stdout may be closed long before the command exits
+        try:
+            returncode = await asyncio.wait_for(communicate(), self.conf.get('shell_timeout', 300))
+        except asyncio.TimeoutError:
+            Util.killpg(process)
+            returncode = await process.wait()
+            output.extend("\n[Timed out after {}s]".format(self.conf.get('shell_timeout', 300)).encode())
+        except asyncio.CancelledError:
+            Util.killpg(process)
+            raise
+        finally:
+            del self.shell_jobs[jobid] # only once the process has exited or been killed
+        return (bytes(output), returncode)
+
+    async def bulk(self, message, items, operation, verb):
+        """Awaits operation(item) for each item, at most bulk_concurrency at a time, showing progress in message.
+
+        Server errors and rate limits are retried up to bulk_retries times with exponential backoff;
+        other errors, including non-HTTP exceptions, fail the item straight away without affecting
+        the others. Returns (items done, [(item, error) ...]).
+        """
+        slots = asyncio.Semaphore(self.conf.get('bulk_concurrency', 4))
+        retries = self.conf.get('bulk_retries', 3)
+        done = []
+        failed = []
+        async def run(item):
+            async with slots:
+                for attempt in range(retries + 1):
+                    try:
+                        await operation(item)
+                        done.append(item)
+                        break
+                    except discord.HTTPException as e:
+                        if attempt == retries or (e.status < 500 and e.status != 429):
+                            failed.append((item, e))
+                            break
+                    except Exception as e:
+                        failed.append((item, e))
+                        break
+                    await asyncio.sleep(self.conf.get('bulk_backoff', 1) * 2 ** attempt)
+            await self.reply(message, "{} {}/{}{}".format(verb, len(done) + len(failed), len(items), ", {} failed".format(len(failed)) if failed else ""), colour=discord.Colour.gold(), progress=True)
+        for item, result in zip(items, await asyncio.gather(*(run(item) for item in items), return_exceptions=True)):
+            if isinstance(result, Exception): # e.g. the progress reply failed; the item itself is accounted for
+                log.warning("Bulk operation on %s failed", item, exc_info=result)
+        return (done, failed)
+
+    async def reply_output(self, message, output, template, **kwargs):
+        """Replies with template(output), attaching output as a file if it does not fit in the embed."""
+        decoded = output.decode("utf-8", "replace")
+        if len(decoded) > 1500:
+            await self.reply(message, template(decoded[:1500] + "..."), **kwargs)
+            await message.channel.send(file=discord.File(BytesIO(output), filename="output.txt"))
+        else:
+            await self.reply(message, template(decoded), **kwargs)
  
+class LogWriter:
+    """Writes log records to the database from a dedicated thread, one transaction per batch.
+
+    Records are queued with put() and flushed once batch_size of them are pending or the oldest
+    has waited max_latency seconds, whichever comes first. stamps maps each guild to the id of its
+    latest committed message; guilds without messages logged since start are at floor. on_commit,
+    if given, is called from the writer thread with (id, row) for each message once it is committed,
+    and on_failure with (table, row) for each record that could not be written.
+    """
+
+    TABLES = ['guilds', 'users', 'channels', 'nicks', 'messages', 'rollups'] # flush order, parents before children
+    STATEMENTS = {
+        'guilds': 'INSERT INTO guilds(guild, name) VALUES(?,?) ON CONFLICT(guild) DO UPDATE SET name=excluded.name',
+        'users': 'INSERT INTO users(user, name) VALUES(?,?) ON CONFLICT(user) DO UPDATE SET name=excluded.name',
+        'channels': 'INSERT INTO channels(channel, guild, name) VALUES(?,?,?) ON CONFLICT(channel) DO UPDATE SET guild=excluded.guild, name=excluded.name',
+        'nicks': 'INSERT INTO nicks(guild, user, nick) VALUES(?,?,?) ON CONFLICT(guild, user) DO UPDATE SET nick=excluded.nick',
+        'messages': 'INSERT INTO messages(guild, channel, message, user, text, time, type) VALUES(?,?,?,?,?,?,?)',
+        'rollups': '''INSERT INTO rollups(guild, channel, user, type, hour, messages, words, first) VALUES(?,?,?,?,?,?,?,?)
+                      ON CONFLICT(guild, channel, user, type, hour) DO UPDATE SET
+                      messages=messages+excluded.messages, words=words+excluded.words, first=min(first, excluded.first)''',
+    }
+
+    def __init__(self, path, batch_size=500, max_latency=1.0, on_commit=None, on_failure=None):
+        self.path = path
+        self.batch_size = batch_size
+        self.max_latency = max_latency
+        self.on_commit = on_commit
+        self.on_failure = on_failure
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self._run, name="LogWriter", daemon=True)
+        self.written = 0
+        self.batches = 0
+        self.errors = 0
+        self.last_flush = 0.0
+        db = sqlite3.connect(path)
+        self.floor = db.execute('SELECT coalesce(max(id), 0) FROM messages').fetchone()[0]
+        db.close()
+        self.stamps = {}
+
+    def start(self):
+        self.thread.start()
+
+    def stamp(self, guild):
+        return self.stamps.get(guild, self.floor)
+
+    def put(self, table, row):
+        self.queue.put((table, row))
+
+    def depth(self):
+        return self.queue.qsize()
+
+    def stop(self):
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+    def _run(self):
+        db = sqlite3.connect(self.path)
+        db.execute('pragma foreign_keys=ON')
+        db.execute('pragma synchronous=NORMAL')
+        stopping = False
+        while not stopping:
+            record = self.queue.get()
+            if record is None:
+                break
+            batch = [record]
+            deadline = time.monotonic() + self.max_latency
+            while len(batch) < self.batch_size:
+                try:
+                    record = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+                if record is None:
+                    stopping = True
+                    break
+                batch.append(record)
+            self._flush(db, batch)
+        db.close()
+
+    def _flush(self, db, batch):
+        start = time.monotonic()
+        rows = {table: [] for table in self.TABLES}
+        for table, row in batch:
+            rows[table].append(row)
+        rows['rollups'] = self.rollup(rows['messages'])
+        try:
+            while True:
+                try:
+                    with db:
+                        for table in self.TABLES:
+                            if rows[table]:
+                                db.executemany(self.STATEMENTS[table], rows[table])
+                        last = db.execute('SELECT max(id) FROM messages').fetchone()[0]
+                    # The batch's messages took consecutive ids ending at last
+                    self.committed(list(enumerate(rows['messages'], last - len(rows['messages']) + 1)))
+                    break
+                except sqlite3.OperationalError as e:
+                    # Someone else (e.g. a full dbmaint) holds the write lock; keep the batch and wait
+                    if 'locked' not in str(e):
+                        raise
+                    time.sleep(1)
+        except sqlite3.Error:
+            log.exception("Could not write a batch of %d log records", len(batch))
+            # One bad record shouldn't cost us the whole batch; retry them one at a time
+            for table, row in sorted(batch, key=lambda r: self.TABLES.index(r[0])):
+                try:
+                    with db:
+                        cursor = db.execute(self.STATEMENTS[table], row)
+                        if table == 'messages':
+                            db.executemany(self.STATEMENTS['rollups'], self.rollup([row]))
+                    if table == 'messages':
+                        self.committed([(cursor.lastrowid, row)])
+                except sqlite3.Error:
+                    self.errors += 1
+                    log.error("Could not log %s record %r", table, row)
+                    if self.on_failure:
+                        self.on_failure(table, row)
+        self.written += len(batch)
+        self.batches += 1
+        self.last_flush = time.monotonic() - start
+
+    def committed(self, messages):
+        if self.on_commit and messages:
+            try:
+                self.on_commit(messages)
+            except Exception:
+                log.exception("on_commit failed for %d messages", len(messages))
+        # Only once on_commit has seen them, so nothing stamped after them is missing them
+        for id, row in messages:
+            if row[0] is not None:
+                self.stamps[row[0]] = id
+
+    @staticmethod
+    def rollup(messages):
+        """Aggregates guild message rows into rollups rows, one per (guild, channel, user, type, hour)."""
+        buckets = {}
+        for guild, channel, _, user, text, timestamp, type in messages:
+            if guild is None:
+                continue
+            key = (guild, channel, user, type, timestamp // 3600)
+            words = len(text.split(' '))
+            if key in buckets:
+                bucket = buckets[key]
+                bucket[0] += 1
+                bucket[1] += words
+                bucket[2] = min(bucket[2], timestamp)
+            else:
+                buckets[key] = [1, words, timestamp]
+        return [key + tuple(bucket) for key, bucket in buckets.items()]
+
+class LogQueueHandler(logging.handlers.QueueHandler):
+    """Queues records for the log listener thread untouched, so that formatting them happens there and not on the event loop."""
+
+    def prepare(self, record):
+        return record
+
+class LagMonitor(logging.Handler):
+    """Measures how late the event loop wakes up from a short sleep, and records what held it up.
+
+    A watchdog thread grabs the loop thread's stack whenever a wakeup is more than threshold late, and
+    names the stall after the innermost frame of that stack.
+    With slow callbacks on, the loop runs in asyncio debug mode and its reports of callbacks that ran
+    longer than threshold arrive here as log records; each stall is kept with the stack, if one was grabbed.
+    Debug mode makes every callback several times slower, so slow callbacks are off unless asked for.
+    """
+
+    def __init__(self, loop, interval=0.25, threshold=0.1, samples=2400, stalls=50):
+        super().__init__(logging.WARNING)
+        self.loop = loop
+        self.interval = interval
+        self.threshold = threshold
+        self.samples = collections.deque(maxlen=samples) # seconds late, one per interval
+        self.stalls = collections.deque(maxlen=stalls) # (unix time, seconds, callback or None, stack or None), latest last
+        self.worst = [] # min-heap of (seconds, sequence, stall), the longest stalls seen
+        self.sequence = itertools.count() # breaks ties between equally long stalls
+        self.heartbeat = time.monotonic()
+        self.blocked = None
+        self.thread = None
+
+    def start(self, slow_callbacks=False):
+        """Starts monitoring. Must be called from the thread that will run the loop."""
+        self.thread = threading.get_ident()
+        self.loop.create_task(self.tick())
+        threading.Thread(target=self.watch, name="lag watchdog", daemon=True).start()
+        if slow_callbacks:
+            self.loop.set_debug(True)
+            self.loop.slow_callback_duration = self.threshold
+            logging.getLogger('asyncio').addHandler(self)
+
+    async def tick(self):
+        while True:
+            self.heartbeat = start = time.monotonic()
+            await asyncio.sleep(self.interval)
+            lag = time.monotonic() - start - self.interval
+            self.samples.append(lag)
+            blocked, self.blocked = self.blocked, None
+            if blocked: # not claimed by a slow callback report
+                where, stack = blocked
+                self.record((time.time(), lag, where, stack))
+
+    def watch(self):
+        grabbed = None
+        while True:
+            time.sleep(self.threshold / 2)
+            heartbeat = self.heartbeat
+            if heartbeat != grabbed and time.monotonic() - heartbeat > self.interval + self.threshold:
+                grabbed = heartbeat
+                frame = sys._current_frames().get(self.thread)
+                if frame is not None:
+                    where = "{} ({}:{})".format(frame.f_code.co_name, os.path.basename(frame.f_code.co_filename), frame.f_lineno)
+                    self.blocked = (where, ''.join(traceback.format_stack(frame)))
+
+    def emit(self, record):
+        if record.msg.startswith('Executing ') and len(record.args) == 2:
+            blocked, self.blocked = self.blocked, None
+            self.record((time.time(), record.args[1], record.args[0], blocked[1] if blocked else None))
+
+    def record(self, stall):
+        self.stalls.append(stall)
+        entry = (stall[1], next(self.sequence), stall)
+        if len(self.worst) < self.stalls.maxlen:
+            heapq.heappush(self.worst, entry)
+        else:
+            heapq.heappushpop(self.worst, entry)
+
+    def worst_stalls(self, n):
+        return [stall for _, _, stall in heapq.nlargest(n, self.worst)]
+
+    def percentile(self, fraction):
+        samples = sorted(self.samples)
+        return samples[int(fraction * (len(samples) - 1))] if samples else 0
+
+class DimensionCache:
+    """Remembers the last value written for each users/guilds/channels/nicks row.
+
+    Each table keeps at most size entries and evicts the least recently used one.
+    """
+
+    QUERIES = {
+        'guilds': 'SELECT guild, name FROM guilds LIMIT ?',
+        'users': 'SELECT user, name FROM users LIMIT ?',
+        'channels': 'SELECT channel, guild, name FROM channels LIMIT ?',
+        'nicks': 'SELECT guild, user, nick FROM nicks LIMIT ?',
+    }
+    KEYS = {'guilds': 1, 'users': 1, 'channels': 1, 'nicks': 2} # leading columns forming the key
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.tables = {table: collections.OrderedDict() for table in self.QUERIES}
+        self.lock = threading.Lock() # the log writer thread forgets rows it failed to write
+        self.hits = 0
+        self.misses = 0
+
+    def warm(self, db):
+        for table, query in self.QUERIES.items():
+            n = self.KEYS[table]
+            for row in db.execute(query, (self.size,)):
+                key = row[0] if n == 1 else row[:n]
+                value = row[n] if len(row) == n + 1 else row[n:]
+                self.tables[table][key] = value
+
+    def changed(self, table, key, value):
+        """Returns True if (key, value) differs from what was last written to table, and records it."""
+        cache = self.tables[table]
+        with self.lock:
+            if key in cache and cache[key] == value:
+                cache.move_to_end(key)
+                self.hits += 1
+                return False
+            cache[key] = value
+            cache.move_to_end(key)
+            if len(cache) > self.size:
+                cache.popitem(last=False)
+            self.misses += 1
+            return True
+
+    def forget(self, table, row):
+        """Drops the entry for a row the log writer failed to write, so that it is written again next time. Called from the log writer thread."""
+        if table in self.tables:
+            n = self.KEYS[table]
+            with self.lock:
+                self.tables[table].pop(row[0] if n == 1 else tuple(row[:n]), None)
+
+    def __len__(self):
+        return sum(len(cache) for cache in self.tables.values())
+
+class ResultCache:
+    """Remembers analytics results, each stamped with the highest messages.id they cover.
+
+    Holds at most size results and evicts the least recently used one. Safe to use from the query pool.
+    """
+
+    def __init__(self, size=128):
+        self.size = size
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.partial = 0
+        self.misses = 0
+
+    def fetch(self, key, stamp, compute, update=None):
+        """Returns the result for key as of stamp.
+
+        compute() builds the result from scratch. update(result, since) returns a copy of a cached
+        result with the messages after since merged in; without it, stale results are recomputed.
+        """
+        with self.lock:
+            cached = self.entries.get(key)
+            if cached and cached[0] == stamp:
+                self.hits += 1
+                self.entries.move_to_end(key)
+                return cached[1]
+            if cached and update and cached[0] < stamp:
+                self.partial += 1
+            else:
+                self.misses += 1
+                cached = None
+        result = update(cached[1], cached[0]) if cached else compute()
+        with self.lock:
+            self.entries[key] = (stamp, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+class Names(dict):
+    """Maps user ids to their display names in a guild.
+
+    Starts from the logged names and the guild's member cache; any other id is looked up once and
+    remembered, falling back to the id itself for users the client has never seen.
+    """
+
+    def __init__(self, client, guild, rows):
+        super().__init__(rows)
+        for member in getattr(guild, 'members', ()): # None once the client has left the guild
+            self.setdefault(member.id, member.display_name)
+        self.client = client
+
+    def __missing__(self, user):
+        found = self.client.get_user(user)
+        name = found.name if found else str(user)
+        self[user] = name
+        return name
+
+class AliasTemplate:
+    """The parameter part of an alias, formatted with the parameters as {0} and their words as {1}, {2}, ...
+
+    Templates using only plain numbered fields are split into literals and field numbers once;
+    anything fancier is left to str.format.
+    """
+
+    __slots__ = ('template', 'pieces', 'words')
+
+    def __init__(self, template):
+        self.template = template
+        self.pieces = None
+        self.words = True
+        try:
+            pieces = [(literal, None if field is None else int(field)) for literal, field, spec, conversion in string.Formatter().parse(template)
+                      if field is None or (field.isdigit() and not spec and not conversion)]
+            if len(pieces) == len(list(string.Formatter().parse(template))):
+                self.pieces = pieces
+                self.words = any(field for _, field in pieces)
+        except ValueError:
+            pass
+
+    def __call__(self, parameters):
+        args = [parameters] + parameters.split(' ') if self.words else [parameters]
+        if self.pieces is None:
+            return self.template.format(*args)
+        return ''.join(literal if field is None else literal + args[field] for literal, field in self.pieces)
+
 class Util:
     def strfdelta(delta):
         output = [[delta.days, 'day'],
@@ -501,6 +1581,70 @@ class Util:
                 seconds += funcs[i[1]](i[0])
         return datetime.timedelta(seconds=seconds)
 
+    def failures(failed, limit=10):
+        """Describes the (item, error) pairs returned by SelfBot.bulk, or returns '' if there are none."""
+        if not failed:
+            return ""
+        listed = ', '.join("{} ({})".format(item, getattr(error, 'text', '') or type(error).__name__) for item, error in failed[:limit])
+        return "\nFailed for **{}**: {}{}".format(len(failed), listed, ", ..." if len(failed) > limit else "")
+
+    def killpg(process):
+        """Kills process and everything it started."""
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+
+def render_init():
+    """Imports the plotting libraries once per render pool worker."""
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot
+    import networkx
+
+def render_graph(edges, spring):
+    """Draws the weighted (a, b, weight) edges as a network and returns it as PNG bytes."""
+    import matplotlib.pyplot
+    import networkx
+    matplotlib.pyplot.close("all")
+    network = networkx.Graph()
+    network.add_weighted_edges_from(edges)
+    pos = networkx.spring_layout(network) if spring else networkx.circular_layout(network)
+    edges, colours = zip(*networkx.get_edge_attributes(network,'weight').items())
+    cmap = matplotlib.pyplot.cm.Blues
+    networkx.draw(network, pos, with_labels=True, node_size=0, font_color="red", edgelist=edges, edge_color=colours, width=4, edge_cmap=cmap, edge_vmin=0)
+    matplotlib.pyplot.tight_layout()
+    imgdata = BytesIO()
+    matplotlib.pyplot.savefig(imgdata, format="PNG")
+    return imgdata.getvalue()
+
+def render_hours(hours):
+    """Draws a histogram of the 24 hourly message counts and returns it as PNG bytes."""
+    import matplotlib.pyplot
+    matplotlib.pyplot.close("all")
+    fig, ax = matplotlib.pyplot.subplots(1, 1)
+    ax.hist(range(24), weights=hours, density=True, bins=24, range=(0,24))
+    ax.set_xlabel('Hour (UTC)');
+    ax.set_xlim([0,24])
+    ax.set_xticks(range(0,24))
+    ax.set_xticklabels(("{}:00".format(h) for h in range(0,24)), rotation=45)
+    matplotlib.pyplot.tight_layout()
+    imgdata = BytesIO()
+    matplotlib.pyplot.savefig(imgdata, format="PNG")
+    return imgdata.getvalue()
+
+def render_pie(labels, sizes):
+    """Draws a pie chart and returns it as PNG bytes."""
+    import matplotlib.pyplot
+    matplotlib.pyplot.close("all")
+    fig, ax = matplotlib.pyplot.subplots(1, 1)
+    ax.pie(sizes, labels=labels, autopct="%1.1f%%", shadow=True)
+    ax.axis('equal')
+    matplotlib.pyplot.tight_layout()
+    imgdata = BytesIO()
+    matplotlib.pyplot.savefig(imgdata, format="PNG")
+    return imgdata.getvalue()
+
 if __name__ == "__main__":
     bot = SelfBot()
 
@@ -518,11 +1662,13 @@ if __name__ == "__main__":
             await bot.reply(message, '*Shutting down*.....', colour=discord.Colour.gold())
             await asyncio.sleep(0.2)
             await message.delete()
+            bot.stopping.set()
             await bot.client.logout()
             await bot.client.close()
         except RuntimeError:
             pass
         finally:
+            bot.logwriter.stop()
             sys.exit(0)
 
     @bot.cmd("```\n{0} takes no arguments\n\nTests the bot's connectivity.```")
@@ -535,6 +1681,92 @@ if __name__ == "__main__":
         embed.set_footer(text="{0} {1}".format(command, parameters), icon_url=bot.client.user.avatar_url)
         await message.edit(content='', embed=embed)
 
+    @bot.cmd("```\n{0} takes no arguments\n\nDisplays the state of the message log writer and its dimension cache.```")
+    async def logstats(bot, message, parameters, recursion=0):
+        writer = bot.logwriter
+        fields = collections.OrderedDict([("Queue depth", writer.depth()),
+                                          ("Records written", writer.written),
+                                          ("Batches", writer.batches),
+                                          ("Failed records", writer.errors),
+                                          ("Last flush", "{:.1f}ms".format(writer.last_flush * 1000)),
+                                          ("Batch size", writer.batch_size),
+                                          ("Max latency", "{}s".format(writer.max_latency)),
+                                          ("Dimension cache", "{} rows, {} hits, {} misses".format(len(bot.dimcache), bot.dimcache.hits, bot.dimcache.misses)),
+                                          ("Result cache", "{} results, {} hits, {} partial, {} misses".format(len(bot.results), bot.results.hits, bot.results.partial, bot.results.misses)),
+                                          ("Column store", "{} guilds, {:.1f}MB, {} evictions".format(len(bot.columns), bot.columns.nbytes() / 1024 / 1024, bot.columns.evictions) if bot.columns else "Disabled")])
+        await bot.reply(message, "", title="Log Writer", fields=fields, colour=discord.Colour.blue())
+
+    @bot.cmd("```\n{0} takes no arguments\n\nShows how late the event loop has been running lately and the worst and latest stalls, with what was running.```")
+    async def lag(bot, message, parameters, recursion=0):
+        monitor = bot.lag
+        fields = collections.OrderedDict([("Samples", "{} over {:.0f}s".format(len(monitor.samples), len(monitor.samples) * monitor.interval))])
+        for name, fraction in [("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("Max", 1)]:
+            fields[name] = "{:.1f}ms".format(monitor.percentile(fraction) * 1000)
+        stalls = list(monitor.stalls)
+        describe = lambda stall: "{:.3f}s at {} in {}".format(stall[1], time.strftime('%H:%M:%S', time.localtime(stall[0])), stall[2] or "unknown callback")
+        if stalls:
+            fields["Worst stalls"] = '\n'.join(describe(stall) for stall in monitor.worst_stalls(5))[:1000]
+            latest = stalls[-1]
+            fields["Latest stall"] = describe(latest)[:1000]
+            if latest[3]:
+                fields["Latest stack"] = "```\n{}```".format(latest[3][-900:])
+        await bot.reply(message, "Stalls are waits longer than {:.0f}ms.".format(monitor.threshold * 1000), title="Event Loop Lag", fields=fields, colour=discord.Colour.blue())
+
+    @bot.cmd("```\n{0} [full]\n\nReclaims free space in the log database, refreshes its statistics and checkpoints its write-ahead log in the background. "
+             "[full] rebuilds the whole database instead, which is needed once for databases created before incremental auto-vacuum.```")
+    async def dbmaint(bot, message, parameters, recursion=0):
+        if parameters not in ['', 'full']:
+            await bot.reply(message, bot.commands['dbmaint'][1].format(message.clean_content.split(' ', 1)[0]), colour=discord.Colour.purple())
+            return
+        await bot.reply(message, "Running {}maintenance...".format("full " if parameters else ""), colour=discord.Colour.gold())
+        result = await bot.client.loop.run_in_executor(None, bot.maintain, parameters == 'full')
+        fields = collections.OrderedDict([("Time taken", "{:.2f}s".format(result['elapsed'])),
+                                          ("Pages reclaimed", "{:.1f} MiB".format(result['freed'] / 2**20)),
+                                          ("Size on disk", "{:.1f} MiB -> {:.1f} MiB".format(result['before'] / 2**20, result['after'] / 2**20))])
+        text = "Maintenance finished."
+        if not result['incremental']:
+            text += " Incremental auto-vacuum is not enabled on this database yet, run `{}dbmaint full` once to enable it.".format(bot.conf['prefix'])
+        await bot.reply(message, text, colour=discord.Colour.green(), fields=fields)
+
+    @bot.cmd("```\n{0} takes no arguments\n\nRecomputes the message count rollups used by stats, topusers and topchans from the whole log, in the background.```")
+    async def rebuildrollups(bot, message, parameters, recursion=0):
+        await bot.reply(message, "Rebuilding rollups...", colour=discord.Colour.gold())
+        rows, elapsed = await bot.client.loop.run_in_executor(None, bot.rebuild_rollups)
+        await bot.reply(message, "Rebuilt **{}** rollup rows in **{:.2f}s**.".format(rows, elapsed), colour=discord.Colour.green())
+
+    @bot.cmd("```\n{0} <command string>\n\nRuns <command string> under cProfile and tracemalloc, then posts the functions that took the most time, "
+             "the lines that allocated the most memory and the full profile as a .pstats file. Everything else running on the event loop "
+             "meanwhile is profiled too; work done in background threads or processes only shows up as waiting.```")
+    async def profile(bot, message, parameters, recursion=0):
+        if parameters == '':
+            await bot.reply(message, bot.commands['profile'][1].format(message.clean_content.split(' ', 1)[0]), colour=discord.Colour.purple())
+            return
+        command, _, params = parameters.partition(' ')
+        profiler = cProfile.Profile()
+        tracing = tracemalloc.is_tracing()
+        if not tracing:
+            tracemalloc.start(bot.conf.get('profile_frames', 1))
+        before = tracemalloc.take_snapshot()
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            await bot.parse_command(message, command, params, recursion + 1)
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - start
+            after = tracemalloc.take_snapshot()
+            if not tracing:
+                tracemalloc.stop()
+        stats = pstats.Stats(profiler).stats
+        functions = sorted(stats.items(), key=lambda item: item[1][3], reverse=True)[:10]
+        allocations = [stat for stat in after.compare_to(before, 'lineno') if stat.size_diff > 0][:5]
+        report = "**Profile of** `{}` ({:.3f}s)\n```\n{}\n```\n**Allocations:**\n```\n{}\n```".format(
+            parameters[:100], elapsed,
+            '\n'.join("{:8.3f}s {:>7} {} ({}:{})".format(cumulative, calls, function, os.path.basename(filename), line)
+                      for (filename, line, function), (_, calls, _, cumulative, _) in functions),
+            '\n'.join("{:>10.1f}KiB {:>7} blocks {}".format(stat.size_diff / 1024, stat.count_diff, stat.traceback[0]) for stat in allocations) or "None")
+        await message.channel.send(report[:2000], file=discord.File(BytesIO(marshal.dumps(stats)), filename="profile.pstats"))
+
     @bot.cmd("```\n{0} <async string>\n\nExecutes <async string> as a coroutine.```", "async")
     async def longasync(bot, message, parameters, recursion=0):
         output, errorcode = await bot._async(message, parameters, recursion)
@@ -620,7 +1852,25 @@ if __name__ == "__main__":
         await message.delete()
         output, errorcode = await bot._exec(message, parameters, recursion)
 
-    @bot.cmd("```\n{0} <string>\n\nQueries the log database.```", "query", "sql")
+    @bot.cmd("```\n{0} <string>\n\nShows how SQLite would run the query <string>.```", "plan")
+    async def explain(bot, message, parameters, recursion=0):
+        output, errorcode = await bot._query(message, parameters, recursion, explain=True)
+        if len(output) > 1500:
+            output = output[:1500] + "..."
+        if errorcode == 3:
+            await bot.reply(message, output, colour=discord.Colour.purple(), footer=message.content.split()[0])
+        else:
+            await bot.reply(message, "**SQL input:**```sql\n{}\n```\n**Query plan:**```\n{}\n```".format(parameters, output), colour=(discord.Colour.red() if errorcode == 2 else discord.Colour.blue()), footer=message.content.split()[0])
+
+    @bot.cmd("```\n{0} takes no arguments\n\nLists the most recent queries that took longer than the slow query threshold.```")
+    async def slowqueries(bot, message, parameters, recursion=0):
+        lines = ["[{:%Y-%m-%d %H:%M:%S}] {:.2f}s: {}".format(*entry) for entry in reversed(bot.slow_queries)]
+        output = '\n'.join(lines) or "none"
+        if len(output) > 1500:
+            output = output[:1500] + "..."
+        await bot.reply(message, "Slow queries (over {}s): ```\n{}\n```".format(bot.conf.get('slow_query_threshold', 1), output), colour=discord.Colour.blue())
+
+    @bot.cmd("```\n{0} <string>\n\nQueries the log database. Queries run in the background and are aborted after the configured query timeout; at most the configured row limit is returned.```", "query", "sql")
     async def longquery(bot, message, parameters, recursion=0):
         output, errorcode = await bot._query(message, parameters, recursion)
         if output is not None and len(output) > 1500:
@@ -653,29 +1903,40 @@ if __name__ == "__main__":
 
     @bot.cmd("```\n{0} <string>\n\nRuns a shell command.```", "shell", "bash")
     async def longshell(bot, message, parameters, recursion=0):
-        output, errorcode = await bot._shell(message, parameters, recursion)
+        async def progress(jobid, output):
+            await bot.reply(message, "**Shell command:**```bash\n{}\n```\n**Output (running as job {}):**```\n{}\n```".format(parameters, jobid, output.decode("utf-8", "replace")[-1500:]), colour=discord.Colour.gold(), footer=message.content.split()[0], progress=True)
+        output, errorcode = await bot._shell(message, parameters, recursion, progress)
         if errorcode is None:
             await bot.reply(message, bot.commands['longshell'][1].format(message.clean_content.split(' ', 1)[0]), colour=discord.Colour.purple(), footer=message.content.split()[0])
             return
-        if len(output) > 1500:
-            output = output[:1500] + "..."
-        await bot.reply(message, "**Shell command:**```bash\n{}\n```\n**Output (Exit code {}):**```\n{}\n```".format(parameters, errorcode, output.decode("utf-8")), colour=(discord.Colour.green() if errorcode == 0 else discord.Colour.red()), footer=message.content.split()[0])
+        await bot.reply_output(message, output, lambda out: "**Shell command:**```bash\n{}\n```\n**Output (Exit code {}):**```\n{}\n```".format(parameters, errorcode, out), colour=(discord.Colour.green() if errorcode == 0 else discord.Colour.red()), footer=message.content.split()[0])
 
     @bot.cmd("```\n{0} <string>\n\nRuns a shell command.```")
     async def shortshell(bot, message, parameters, recursion=0):
-        output, errorcode = await bot._shell(message, parameters, recursion)
+        async def progress(jobid, output):
+            await bot.reply(message, "```\n{}\n```".format(output.decode("utf-8", "replace")[-1500:]), colour=discord.Colour.gold(), footer=message.content.split()[0], progress=True)
+        output, errorcode = await bot._shell(message, parameters, recursion, progress)
         if errorcode is None:
             await bot.reply(message, bot.commands['shortshell'][1].format(message.clean_content.split(' ', 1)[0]), colour=discord.Colour.purple(), footer=message.content.split()[0])
             return
-        if len(output) > 1500:
-            output = output[:1500] + "..."
-        await bot.reply(message, "```\n{}\n```".format(output.decode("utf-8")), colour=(discord.Colour.green() if errorcode == 0 else discord.Colour.red()), footer=message.content.split()[0])
+        await bot.reply_output(message, output, "```\n{}\n```".format, colour=(discord.Colour.green() if errorcode == 0 else discord.Colour.red()), footer=message.content.split()[0])
 
     @bot.cmd("```\n{0} <string>\n\nRuns a shell command.```")
     async def silentshell(bot, message, parameters, recursion=0):
         await message.delete()
         output, errorcode = await bot._shell(message, parameters, recursion)
 
+    @bot.cmd("```\n{0} [<job id>]\n\nLists running shell commands, or kills the one with <job id>.```", "shellkill")
+    async def shelljobs(bot, message, parameters, recursion=0):
+        if parameters == '':
+            jobs = ["{} (running for {}): {}".format(jobid, Util.strfdelta(datetime.datetime.now() - started), command) for jobid, (command, _, started) in sorted(bot.shell_jobs.items())]
+            await bot.reply(message, "Running shell commands: ```\n{}\n```".format('\n'.join(jobs) or "none"), colour=discord.Colour.blue())
+        elif parameters.isdigit() and int(parameters) in bot.shell_jobs:
+            Util.killpg(bot.shell_jobs[int(parameters)][1])
+            await bot.reply(message, "Killed shell job **{}**.".format(parameters), colour=discord.Colour.green())
+        else:
+            await bot.reply(message, "ERROR: shell job {} does not exist!".format(parameters), colour=discord.Colour.red())
+
     @bot.cmd("```\n{0} [<user>]\n\nDisplays information about [<user>].```", "uinfo")
     async def userinfo(bot, message, parameters, recursion=0):
         msg_guild = message.guild
@@ -770,9 +2031,8 @@ if __name__ == "__main__":
             for member in guild.members:
                 if role in member.roles:
                     members_with_role.append(member)
-            for member in members_with_role:
-                await member.remove_roles(role)
-            await bot.reply(message, "Removed role **{}** from **{}** member{}.".format(role.name, len(members_with_role), '' if len(members_with_role) == 1 else 's'), colour=discord.Colour.green())
+            done, failed = await bot.bulk(message, members_with_role, lambda member: member.remove_roles(role), "Removing **{}**:".format(role.name))
+            await bot.reply(message, "Removed role **{}** from **{}** member{}.{}".format(role.name, len(done), '' if len(done) == 1 else 's', Util.failures(failed)), colour=(discord.Colour.orange() if failed else discord.Colour.green()))
         else:
             await bot.reply(message, "ERROR: could not find role named {}. Please ensure the role is spelled correctly and your capitalization is correct.".format(parameters), colour=discord.Colour.red())
 
@@ -846,13 +2106,12 @@ if __name__ == "__main__":
             function = discord.Member.add_roles
         elif action == 'remove':
             function = discord.Member.remove_roles
-        for member in members:
-            await function(member, role)
+        done, failed = await bot.bulk(message, members, lambda member: function(member, role), "Updating **{}**:".format(role.name))
         if action == 'add':
-            msg = "Successfully added **{}** to **{}** member{}."
+            msg = "Successfully added **{}** to **{}** member{}.{}"
         elif action == 'remove':
-            msg = "Successfully removed **{}** from **{}** member{}."
-        await bot.reply(message, msg.format(role.name, len(members), '' if len(members) == 1 else 's'), colour=discord.Colour.green())
+            msg = "Successfully removed **{}** from **{}** member{}.{}"
+        await bot.reply(message, msg.format(role.name, len(done), '' if len(done) == 1 else 's', Util.failures(failed)), colour=(discord.Colour.orange() if failed else discord.Colour.green()))
 
     @bot.cmd("```\n{0} <command>\n\nDisplays hopefully helpful information on <command>. Try {0}list for a listing of commands.```")
     async def help(bot, message, parameters, recursion=0):
@@ -936,22 +2195,22 @@ if __name__ == "__main__":
             return
         if len(params) == 1:
             if action in ['add', '+', 'edit', '=']:
-                await bot.reply(message, "```\n{0}alias {1} <alias name> <command string>```".format(prefix, action), colour=discord.Colour.purple())
+                await bot.reply(message, "```\n{0}alias {1} <alias name> <command string>```".format(bot.conf['prefix'], action), colour=discord.Colour.purple())
             elif action in ['show', 'remove', '-', 'del', 'delete']:
-                await bot.reply(message, "```\n{0}alias {1} <alias name>```".format(prefix, action), colour=discord.Colour.purple())
+                await bot.reply(message, "```\n{0}alias {1} <alias name>```".format(bot.conf['prefix'], action), colour=discord.Colour.purple())
             elif action == 'list':
-                await bot.reply(message, "Available aliases: {}".format(', '.join(sorted(aliases))), colour=discord.Colour.blue())
+                await bot.reply(message, "Available aliases: {}".format(', '.join(sorted(bot.aliases))), colour=discord.Colour.blue())
             return
         alias = params[1]
         if not alias in bot.aliases and action not in ['add', '+']:
             await bot.reply(message, "ERROR: alias {} does not exist!".format(alias), colour=discord.Colour.red())
             return
         if alias in bot.aliases and action in ['add', '+']:
-            await bot.reply(message, "ERROR: alias {} already exists. Use `{}alias edit` instead.".format(alias, prefix), colour=discord.Colour.red())
+            await bot.reply(message, "ERROR: alias {} already exists. Use `{}alias edit` instead.".format(alias, bot.conf['prefix']), colour=discord.Colour.red())
             return
         if len(params) == 2:
             if action in ['add', '+', 'edit', '=']:
-                await bot.reply(message, "```\n{0}alias {1} {2} <command string>```".format(prefix, action, alias), colour=discord.Colour.purple())
+                await bot.reply(message, "```\n{0}alias {1} {2} <command string>```".format(bot.conf['prefix'], action, alias), colour=discord.Colour.purple())
             elif action == 'show':
                 await bot.reply(message, "**{}** is an alias for: ```\n{}\n```".format(alias, bot.aliases[alias]), colour=discord.Colour.purple())
             elif action in ['remove', 'del', 'delete', '-']:
@@ -959,45 +2218,59 @@ if __name__ == "__main__":
                 await bot.reply(message, "Successfully deleted alias **{}**.".format(alias), colour=discord.Colour.green())
         else:
             commandstring = ' '.join(params[2:])
+            previous = bot.aliases.get(alias)
             bot.aliases[alias] = commandstring
+            bot.alias_chains = {}
+            try:
+                bot.alias_chain(alias)
+            except ValueError as e:
+                if previous is None:
+                    del bot.aliases[alias]
+                else:
+                    bot.aliases[alias] = previous
+                bot.alias_chains = {}
+                await bot.reply(message, "ERROR: {}".format(e), colour=discord.Colour.red())
+                return
             await bot.reply(message, "Successfully {} alias **{}**.".format(action + "ed", alias), colour=discord.Colour.green())
-        with open('aliases.json', 'w') as aliases_file:
-            json.dump(bot.aliases, aliases_file)
+        bot.save_aliases()
 
-    @bot.cmd("```\n{0} <add | remove | list | show> <id or date string> [command string]\n\nSchedules commands. Date string is in the "
-                      "format #d#h#m#s, corresponding to days, hours, minutes, and seconds. You may omit up to 3 of the aforementioned categories.```")
+    @bot.cmd("```\n{0} <add | repeat | remove | list | show> <id or date string> [command string]\n\nSchedules commands. Date string is in the "
+                      "format #d#h#m#s, corresponding to days, hours, minutes, and seconds. You may omit up to 3 of the aforementioned categories. "
+                      "Commands added with repeat run again every <date string> until removed. Scheduled commands survive restarts.```")
     async def scheduler(bot, message, parameters, recursion=0):
         params = parameters.split(' ')
         if len(params) == 0:
             await bot.reply(message, bot.commands['scheduler'][1].format(message.clean_content.split(' ', 1)[0]), colour=discord.Colour.purple())
             return
         action = params[0]
-        if action not in ['add', '+', 'remove', 'del', 'delete', '-', 'list', 'show']:
+        if action not in ['add', '+', 'repeat', 'every', 'remove', 'del', 'delete', '-', 'list', 'show']:
             await bot.reply(message, bot.commands['scheduler'][1].format(message.clean_content.split(' ', 1)[0]), colour=discord.Colour.purple())
             return
+        def describe(schid):
+            due, _, commandstring, _, interval = bot.scheduler[schid]
+            every = " every {}".format(Util.strfdelta(interval)) if interval else ""
+            return "{} (in {}{}): {}".format(schid, Util.strfdelta(due - datetime.datetime.now()), every, commandstring)
         if len(params) == 1:
-            if action in ['add', '+']:
-                await bot.reply(message, "```\n{0}scheduler {1} <date string> <command string>```".format(prefix, action), colour=discord.Colour.purple())
+            if action in ['add', '+', 'repeat', 'every']:
+                await bot.reply(message, "```\n{0}scheduler {1} <date string> <command string>```".format(bot.conf['prefix'], action), colour=discord.Colour.purple())
             elif action in ['show', 'remove', '-', 'del', 'delete']:
-                await bot.reply(message, "```\n{0}scheduler {1} <id>```".format(prefix, action), colour=discord.Colour.purple())
+                await bot.reply(message, "```\n{0}scheduler {1} <id>```".format(bot.conf['prefix'], action), colour=discord.Colour.purple())
             elif action == 'list':
-                await bot.reply(message, "Currently scheduled commands: ```\n{}\n```".format('\n'.join(sorted(["{} (in {}): {}".format(
-                    x, Util.strfdelta(bot.scheduler[x][0] - datetime.datetime.now()), bot.scheduler[x][2]) for x in bot.scheduler]))), colour=discord.Colour.blue())
+                await bot.reply(message, "Currently scheduled commands: ```\n{}\n```".format('\n'.join(describe(x) for x in sorted(bot.scheduler))), colour=discord.Colour.blue())
             return
         iddatestring = params[1]
-        if not iddatestring in map(str, bot.scheduler) and action not in ['add', '+']:
+        if not iddatestring in map(str, bot.scheduler) and action not in ['add', '+', 'repeat', 'every']:
             await bot.reply(message, "ERROR: id {} does not exist!".format(iddatestring), colour=discord.Colour.red())
             return 
         if len(params) == 2:
-            if action in ['add', '+', 'edit', '=']:
-                await bot.reply(message, "```\n{0}alias {1} {2} <command string>```".format(prefix, action, iddatestring), colour=discord.Colour.purple())
+            if action in ['add', '+', 'repeat', 'every']:
+                await bot.reply(message, "```\n{0}scheduler {1} {2} <command string>```".format(bot.conf['prefix'], action, iddatestring), colour=discord.Colour.purple())
             elif action == 'show':
                 iddatestring = int(iddatestring)
-                await bot.reply(message, "ID **{}** is scheduled to run in **{}**: ```\n{}\n```".format(
-                            iddatestring, Util.strfdelta(bot.scheduler[iddatestring][0] - datetime.datetime.now()), bot.scheduler[iddatestring][2]), colour=discord.Colour.blue())
+                await bot.reply(message, "ID **{}** is scheduled: ```\n{}\n```".format(iddatestring, describe(iddatestring)), colour=discord.Colour.blue())
             elif action in ['remove', 'del', 'delete', '-']:
                 iddatestring = int(iddatestring)
-                del bot.scheduler[iddatestring]
+                bot.unschedule(iddatestring)
                 await bot.reply(message, "Successfully deleted scheduled command with id **{}**.".format(iddatestring), colour=discord.Colour.green())
         else:
             if bot.scheduler:
@@ -1006,8 +2279,15 @@ if __name__ == "__main__":
                 schid = 0
             commandstring = ' '.join(params[2:])
             delta = Util.convdatestring(iddatestring)
-            bot.scheduler[schid] = [datetime.datetime.now() + delta, message, commandstring, recursion + 1]
-            await bot.reply(message, "Successfully scheduled command with id **{}** to run in **{}**: ```\n{}\n```".format(schid, Util.strfdelta(delta), commandstring), colour=discord.Colour.green())
+            interval = None
+            if action in ['repeat', 'every']:
+                if not delta:
+                    await bot.reply(message, "ERROR: a repeating command needs a non-zero interval.", colour=discord.Colour.red())
+                    return
+                interval = delta
+            bot.schedule(schid, datetime.datetime.now() + delta, message, commandstring, recursion + 1, interval)
+            await bot.reply(message, "Successfully scheduled command with id **{}** to run in **{}**{}: ```\n{}\n```".format(
+                        schid, Util.strfdelta(delta), " and every {} after that".format(Util.strfdelta(delta)) if interval else "", commandstring), colour=discord.Colour.green())
 
     @bot.cmd("```\n{0} <date string>\n\nDisplays a running timer. Date string is in the format #d#h#m#s, corresponding to days, "
                   "hours, minutes, and seconds. You may omit up to 3 of the aforementioned categories.```")
@@ -1024,23 +2304,64 @@ if __name__ == "__main__":
             await bot.reply(message, "Timer of **" + parameters + "** finished successfully!", colour=discord.Colour.green())
         bot.client.loop.create_task(timer_task())
 
-    @bot.cmd("```\n{0} <number of messages>\n\nPurges messages from the current channel.```")
+    @bot.cmd("```\n{0} <number of messages> [author:<user>] [match:<regex>] [before:<message id>] [after:<message id>]\n\nPurges messages from the current channel, "
+             "optionally only those by <user>, matching <regex>, or between two messages, newest first. At most purge_scan_limit messages are looked at.```")
     async def purge(bot, message, parameters, recursion=0):
+        params = parameters.split(' ')
         if parameters == '':
             await bot.reply(message, bot.commands['purge'][1].format(message.clean_content.split(' ', 1)[0]), colour=discord.Colour.purple())
             return
-        if not parameters.isdigit():
+        if not params[0].isdigit() or int(params[0]) < 1:
             await bot.reply(message, "Error: Number of messages to purge must be a positive integer.", colour=discord.Colour.red())
             return
-
-        msglist = message.channel.history(limit=int(parameters) + 1)
-        await msglist.next()
-        async for msg in msglist:
+        count = int(params[0])
+        filters = {}
+        for param in params[1:]:
+            key, sep, value = param.partition(':')
+            if not sep or not value or key not in ['author', 'match', 'before', 'after']:
+                await bot.reply(message, bot.commands['purge'][1].format(message.clean_content.split(' ', 1)[0]), colour=discord.Colour.purple())
+                return
+            filters[key] = value
+        for key in ['author', 'before', 'after']:
+            if key in filters:
+                if not filters[key].strip("<!@>").isdigit():
+                    await bot.reply(message, "Error: {} must be an id.".format(key), colour=discord.Colour.red())
+                    return
+                filters[key] = int(filters[key].strip("<!@>"))
+        if 'match' in filters:
             try:
-                await msg.delete()
-            except:
-                pass
-        await bot.reply(message, "Successfully purged **" + parameters + "** messages! :thumbsup:", discord.Colour.green())
+                filters['match'] = re.compile(filters['match'])
+            except re.error as e:
+                await bot.reply(message, "Error: invalid regex: {}".format(e), colour=discord.Colour.red())
+                return
+
+        before = discord.Object(id=filters['before']) if 'before' in filters else message
+        after = discord.Object(id=filters['after']) if 'after' in filters else None
+        recent = []
+        old = []
+        cutoff = datetime.datetime.utcnow() - datetime.timedelta(days=14, minutes=-5) # bulk deletes refuse messages older than 14 days
+        async for msg in message.channel.history(limit=bot.conf.get('purge_scan_limit', 10000), before=before, after=after, oldest_first=False):
+            if 'author' in filters and msg.author.id != filters['author']:
+                continue
+            if 'match' in filters and not filters['match'].search(msg.content):
+                continue
+            (recent if msg.created_at > cutoff else old).append(msg)
+            if len(recent) + len(old) >= count:
+                break
+
+        channel = message.channel
+        if bot.client.user.bot and isinstance(channel, discord.TextChannel) and channel.permissions_for(channel.guild.me).manage_messages:
+            chunks = [recent[i:i + 100] for i in range(0, len(recent), 100)]
+            done, failed = await bot.bulk(message, chunks, channel.delete_messages, "Purging (bulk):")
+            deleted = sum(len(chunk) for chunk in done)
+            old += [msg for chunk, _ in failed for msg in chunk]
+        else: # user accounts can't bulk delete
+            deleted = 0
+            old = recent + old
+        done, failed = await bot.bulk(message, old, lambda msg: msg.delete(), "Purging:")
+        deleted += len(done)
+        await bot.reply(message, "Successfully purged **{}** message{}! :thumbsup:{}".format(deleted, '' if deleted == 1 else 's', Util.failures([(msg.id, error) for msg, error in failed])),
+                        colour=(discord.Colour.orange() if failed else discord.Colour.green()))
         await asyncio.sleep(2)
         await message.delete()
 
@@ -1099,11 +2420,9 @@ if __name__ == "__main__":
             await bot.reply(message, "**Error**: No such voice channel {}".format(params[1]), colour=discord.Colour.red())
             return
 
-        users = source.members
-        for member in users:
-            await member.edit(voice_channel=target)
+        done, failed = await bot.bulk(message, list(source.members), lambda member: member.edit(voice_channel=target), "Moving to {}:".format(target))
 
-        await bot.reply(message, "Moved {} users from {} to {} :thumbsup:".format(len(users), source, target), colour=discord.Colour.green())
+        await bot.reply(message, "Moved {} users from {} to {} :thumbsup:{}".format(len(done), source, target, Util.failures(failed)), colour=(discord.Colour.orange() if failed else discord.Colour.green()))
 
     @bot.cmd("```\n{0} [user]\n\nDisplays seen information about [<user>].```")
     async def seen(bot, message, parameters, recursion=0):
@@ -1116,18 +2435,7 @@ if __name__ == "__main__":
         else:
             user = int(user)
 
-        cursor = bot.logdb.cursor()
-        cursor.execute('''
-            SELECT datetime(m.time, 'unixepoch') as timestamp, g.name as guild, c.name as channel, CASE WHEN n.nick IS NULL THEN u.name ELSE n.nick END as name, m.text, m.type FROM messages AS m
-            INNER JOIN guilds AS g ON m.guild = g.guild
-            INNER JOIN channels AS c ON m.channel = c.channel
-            INNER JOIN users AS u ON m.user = u.user
-            INNER JOIN nicks AS n ON m.guild = n.guild AND m.user = n.user
-            WHERE m.guild IS NOT NULL AND m.user = ?
-            ORDER BY m.time DESC
-            LIMIT 1
-        ''', (user,))
-        row = cursor.fetchone()
+        row = bot.last_seen(user)
         if not row:
             await bot.reply(message, "I have not seen {} recently.".format(parameters), colour=discord.Colour.orange())
         else:
@@ -1136,6 +2444,46 @@ if __name__ == "__main__":
             else:
                 await bot.reply(message, 'Last saw **{3}** editing a message to "{4}" in channel **#{2}** on server **{1}** at **{0} UTC**'.format(*row), colour=discord.Colour.green())
 
+    @bot.cmd("```\n{0} [in:<channel>] [from:<user>] [after:<date string>] [before:<date string>] [page:<n>] <query>\n\nSearches logged messages in this "
+             "server (or everywhere, in a pm). <query> uses SQLite FTS5 syntax. Date strings are in the format #d#h#m#s and count back from now.```")
+    async def search(bot, message, parameters, recursion=0):
+        filters = {}
+        words = []
+        for word in parameters.split(' '):
+            key, sep, value = word.partition(':')
+            if sep and value and key in ['in', 'from', 'after', 'before', 'page']:
+                if key in filters:
+                    await bot.reply(message, "ERROR: `{}:` may only be given once.".format(key), colour=discord.Colour.red())
+                    return
+                filters[key] = value
+            elif word:
+                words.append(word)
+        if not words:
+            await bot.reply(message, bot.commands['search'][1].format(message.clean_content.split(' ', 1)[0]), colour=discord.Colour.purple())
+            return
+        channel = filters.get('in', '').strip("<#>")
+        user = filters.get('from', '').strip("<!@>")
+        page = filters.get('page', '1')
+        if not (channel.isdigit() or not channel) or not (user.isdigit() or not user) or not page.isdigit() or int(page) < 1:
+            await bot.reply(message, bot.commands['search'][1].format(message.clean_content.split(' ', 1)[0]), colour=discord.Colour.purple())
+            return
+        now = time.time()
+        after = now - Util.convdatestring(filters['after']).total_seconds() if 'after' in filters else None
+        before = now - Util.convdatestring(filters['before']).total_seconds() if 'before' in filters else None
+        page = int(page)
+        query = ' '.join(words)
+        try:
+            results = await bot.client.loop.run_in_executor(bot.query_pool, functools.partial(bot.search, query, message.guild.id if message.guild else None,
+                                                            int(channel) if channel else None, int(user) if user else None, after, before, limit=10, offset=(page - 1) * 10))
+        except sqlite3.OperationalError as e:
+            await bot.reply(message, "ERROR: {}".format(e), colour=discord.Colour.red())
+            return
+        if not results:
+            await bot.reply(message, "No results for `{}`.".format(query), colour=discord.Colour.orange(), footer="Page {}".format(page))
+            return
+        fields = collections.OrderedDict([("#{1} <{2}> {0}".format(*row), row[3][:1000]) for row in results])
+        await bot.reply(message, "Results for `{}`:".format(query), colour=discord.Colour.green(), fields=fields, footer="Page {}".format(page))
+
     @bot.cmd("```\n{0} [user]\n\nPicks between several choices.```")
     async def choose(bot, message, parameters, recursion=0):
         if not parameters.strip():
@@ -1149,17 +2497,12 @@ if __name__ == "__main__":
     async def stats(bot, message, parameters, recursion=0):
         params = parameters.split(' ')
         title = "Stats"
-        data = []
 
         if len(params) > 2:
             await bot.reply(message, bot.commands['stats'][1].format(message.clean_content.split(' ', 1)[0]), colour=discord.Colour.purple())
             return
 
-        class Entry:
-            def __init__(self, entry):
-                self.time = entry[0]
-                self.name = entry[1]
-                self.text = entry[2]
+        names = bot.guild_names(message.guild)
 
         if parameters:
             channel = None
@@ -1180,70 +2523,23 @@ if __name__ == "__main__":
                 title = "Stats for **{}** in channel **{}** on server **{}**".format(params[1], discord.utils.get(message.guild.channels, id=channel).name, message.guild.name)
             else:
                 title = "Stats for channel **{}** on server **{}**".format(discord.utils.get(message.guild.channels, id=channel).name, message.guild.name)
-            await bot.reply(message, "", title="Fetching: {}".format(title))
-            cursor = bot.logdb.cursor()
-            cursor.execute('''
-                SELECT m.time, CASE WHEN n.nick IS NULL THEN u.name else n.nick END as name, m.text FROM messages AS m
-                INNER JOIN users AS u ON m.user = u.user
-                INNER JOIN nicks AS n ON m.guild = n.guild AND m.user = n.user
-                WHERE m.guild = ? AND m.channel = ? AND m.type = 0
-                ORDER BY m.time ASC
-            ''', (message.guild.id, channel))
-            data = [Entry(e) for e in cursor.fetchall()]
         else:
+            channel = None
             title = "Stats for server **{}**".format(message.guild.name)
-            await bot.reply(message, "", title="Fetching: {}".format(title))
-            cursor = bot.logdb.cursor()
-            cursor.execute('''
-                SELECT m.time, CASE WHEN n.nick IS NULL THEN u.name else n.nick END as name, m.text FROM messages AS m
-                INNER JOIN users AS u ON m.user = u.user
-                INNER JOIN nicks AS n ON m.guild = n.guild AND m.user = n.user
-                WHERE m.guild = ? AND m.type = 0
-                ORDER BY m.time ASC
-            ''', (message.guild.id,))
-            data = [Entry(e) for e in cursor.fetchall()]
-
-        await bot.reply(message, "{} messages".format(len(data)), title="Generating: {}".format(title))
-        graph = {}
-        for i, msg in enumerate(data[1:-1]):
-            pred = data[i-1]
-            succ = data[i+1]
-
-            pkey = (min(msg.name, pred.name), max(msg.name, pred.name))
-            skey = (min(msg.name, succ.name), max(msg.name, succ.name))
-
-            if pkey[0] != pkey[1]:
-                graph[pkey] = graph.get(pkey, 0) + 1
-            if skey[0] != skey[1]:
-                graph[skey] = graph.get(skey, 0) + 1
-
-            mentions = re.finditer(MENTION_REGEX, msg.text)
-            for match in mentions:
-                cursor = bot.logdb.cursor()
-                user = int(match.group(1))
-                cursor.execute('''
-                    SELECT CASE WHEN n.nick IS NULL THEN u.name ELSE n.nick END as name FROM users AS u
-                    INNER JOIN nicks AS n ON n.guild = ? AND n.user = u.user
-                    WHERE u.user = ?
-                ''', (message.guild.id, user))
-                name = cursor.fetchone()
-                if name is None:
-                    member = message.guild.get_member(user)
-                    if m is not None:
-                        name = member.display_name
-                    else:
-                        user = bot.client.get_user(user)
-                        name = user.name
-                else:
-                    name = name[0]
 
-                key = (min(msg.name, name), max(msg.name, name))
+        await bot.reply(message, "", title="Fetching: {}".format(title), progress=True)
+        await bot.load_columns(message.guild.id)
+        count, pairs = await bot.client.loop.run_in_executor(bot.query_pool, bot.conversation_graph, message.guild.id, channel)
 
-                if key[0] != key[1]:
-                    graph[key] = graph.get(key, 0) + 1
+        await bot.reply(message, "{} messages".format(count), title="Generating: {}".format(title), progress=True)
+        graph = {}
+        for (a, b), weight in pairs.items():
+            key = (min(names[a], names[b]), max(names[a], names[b]))
+            if key[0] != key[1]:
+                graph[key] = graph.get(key, 0) + weight
 
         threshold = 10
-        await bot.reply(message, "{} messages total, {} datapoints".format(len(data), len(graph)), title="Trimming: {}".format(title), fields={"Threshold":str(threshold), "Graph":repr(graph)[:1000]+"..."})
+        await bot.reply(message, "{} messages total, {} datapoints".format(count, len(graph)), title="Trimming: {}".format(title), fields={"Threshold":str(threshold), "Graph":repr(graph)[:1000]+"..."}, progress=True)
         edges = []
         uname = None
         if len(params) == 2:
@@ -1253,94 +2549,48 @@ if __name__ == "__main__":
             else:
                 await bot.reply(message, "ERROR: Please enter a valid user.", colour=discord.Colour.red())
                 return
-            cursor.execute('''
-                SELECT CASE WHEN n.nick IS NULL THEN u.name ELSE n.nick END as name FROM users AS u
-                INNER JOIN nicks AS n ON n.guild = ? AND n.user = u.user
-                WHERE u.user = ?
-            ''', (message.guild.id, user))
-            name = cursor.fetchone()
-            if name is None:
-                member = message.guild.get_member(user)
-                if m is not None:
-                    uname = member.display_name
-                else:
-                    user = bot.client.get_user(user)
-                    uname = user.name
-            else:
-                uname = name[0]
+            uname = names[user]
             edges = [(k[0], k[1], math.log(v)) for k,v in graph.items() if v > threshold and uname in [k[0],k[1]]]
         else:
             edges = [(k[0], k[1], math.log(v)) for k,v in graph.items() if v > threshold]
 
-        await bot.reply(message, "{} messages total, {} datapoints".format(len(data), len(edges)), title="Pre-Rendering: {}".format(title), fields={"Graph Data":repr(edges)[:1000]+"..."})
-        import networkx
-        network = networkx.Graph()
-        network.add_weighted_edges_from(edges)
-        adj = '\n'.join(networkx.generate_adjlist(network))
-
-        await bot.reply(message, "{} messages total, {} nodes, {} edges".format(len(data), network.number_of_nodes(), network.number_of_edges()), title="Rendering (Pass 1): {}".format(title), fields={"Graph":adj[:1000]+"..."})
-        import matplotlib
-        matplotlib.use('Agg')
-        import matplotlib.pyplot
-        matplotlib.pyplot.close("all")
-        pos = networkx.spring_layout(network) if len(params) == 2 else networkx.circular_layout(network)
-        edges, colours = zip(*networkx.get_edge_attributes(network,'weight').items())
-        cmap = matplotlib.pyplot.cm.Blues
-        networkx.draw(network, pos, with_labels=True, node_size=0, font_color="red", edgelist=edges, edge_color=colours, width=4, edge_cmap=cmap, edge_vmin=0)
-        matplotlib.pyplot.tight_layout()
-        imgdata = BytesIO()
-        matplotlib.pyplot.savefig(imgdata, format="PNG")
-        imgdata.seek(0)
-        await message.channel.send(title, file=discord.File(imgdata, filename="stats.png"))
-
-        await bot.reply(message, "{} messages total, {} nodes, {} edges".format(len(data), network.number_of_nodes(), network.number_of_edges()), title="Generating: {}".format(title))
-        msgcounts = {}
-        hourdata = []
-        for entry in data:
-            msgcounts[entry.name] = msgcounts.get(entry.name, 0) + 1
-            if len(params) == 2 and entry.name != uname:
-                continue
-            hourdata.append((entry.time % 86400) / 3600)
-
-        await bot.reply(message, "{} messages total, {} nodes, {} edges".format(len(data), network.number_of_nodes(), network.number_of_edges()), title="Rendering (Pass 2): {}".format(title))
-        import matplotlib.dates
-        matplotlib.pyplot.close("all")
-        fig, ax = matplotlib.pyplot.subplots(1, 1)
-        ax.hist(hourdata, normed=True, bins=48)
-        ax.set_xlabel('Hour (UTC)');
-        ax.set_xlim([0,24])
-        ax.set_xticks(range(0,24))
-        ax.set_xticklabels(("{}:00".format(h) for h in range(0,24)), rotation=45)
-        matplotlib.pyplot.tight_layout()
-        imgdata = BytesIO()
-        matplotlib.pyplot.savefig(imgdata, format="PNG")
-        imgdata.seek(0)
-        await message.channel.send(title, file=discord.File(imgdata, filename="stats.png"))
+        await bot.reply(message, "{} messages total, {} datapoints".format(count, len(edges)), title="Pre-Rendering: {}".format(title), fields={"Graph Data":repr(edges)[:1000]+"..."}, progress=True)
+        adjacency = collections.OrderedDict()
+        for a, b, _ in edges:
+            adjacency.setdefault(a, []).append(b)
+            adjacency.setdefault(b, [])
+        adj = '\n'.join(' '.join([node] + neighbours) for node, neighbours in adjacency.items())
+        nodes = len(adjacency)
+
+        await bot.reply(message, "{} messages total, {} nodes, {} edges".format(count, nodes, len(edges)), title="Rendering (Pass 1): {}".format(title), fields={"Graph":adj[:1000]+"..."}, progress=True)
+        imgdata = await bot.render(message, render_graph, edges, len(params) == 2)
+        await message.channel.send(title, file=discord.File(BytesIO(imgdata), filename="stats.png"))
+
+        await bot.reply(message, "{} messages total, {} nodes, {} edges".format(count, nodes, len(edges)), title="Generating: {}".format(title), progress=True)
+        totals = await bot.client.loop.run_in_executor(bot.query_pool, functools.partial(bot.user_totals, message.guild.id, channel, user if len(params) == 2 else None, type=0, limit=10))
+        hours = await bot.client.loop.run_in_executor(bot.query_pool, bot.hour_totals, message.guild.id, channel, user if len(params) == 2 else None)
+
+        await bot.reply(message, "{} messages total, {} nodes, {} edges".format(count, nodes, len(edges)), title="Rendering (Pass 2): {}".format(title), progress=True)
+        imgdata = await bot.render(message, render_hours, hours)
+        await message.channel.send(title, file=discord.File(BytesIO(imgdata), filename="stats.png"))
 
         if len(params) == 2:
-            await bot.reply(message, "*{} messages ({} total), {} nodes, {} edges*".format(msgcounts[uname], len(data), network.number_of_nodes(), network.number_of_edges()), title=title)
+            await bot.reply(message, "*{} messages ({} total), {} nodes, {} edges*".format(sum(row[2] for row in totals), count, nodes, len(edges)), title=title)
         else:
-            fields = collections.OrderedDict([(k, "{} messages".format(msgcounts[k])) for k in sorted(msgcounts, key=msgcounts.get, reverse=True)[:10]])
-            await bot.reply(message, "*{} messages total, {} nodes, {} edges*\n**Top 10 users**:".format(len(data), network.number_of_nodes(), network.number_of_edges()), title=title, fields=fields)
+            fields = collections.OrderedDict([(row[1], "{} messages".format(row[2])) for row in totals])
+            await bot.reply(message, "*{} messages total, {} nodes, {} edges*\n**Top 10 users**:".format(count, nodes, len(edges)), title=title, fields=fields)
 
     @bot.cmd("```\n{0} [channel [user]]\n\n Get stats about the server or a channel```", pm=False)
     async def topusers(bot, message, parameters, recursion=0):
         params = parameters.split(' ')
         title = "Stats"
-        data = []
 
         if len(params) > 2:
             await bot.reply(message, bot.commands['topusers'][1].format(message.clean_content.split(' ', 1)[0]), colour=discord.Colour.purple())
             return
 
-        class Entry:
-            def __init__(self, entry):
-                self.time = entry[0]
-                self.name = entry[1]
-                self.text = entry[2]
-
+        channel = None
         if parameters:
-            channel = None
             try:
                 channel = int(params[0].strip("<#>"))
             except ValueError:
@@ -1358,32 +2608,14 @@ if __name__ == "__main__":
                 title = "Stats for **{}** in channel **{}** on server **{}**".format(params[1], discord.utils.get(message.guild.channels, id=channel).name, message.guild.name)
             else:
                 title = "Top Users for channel **{}** on server **{}**".format(discord.utils.get(message.guild.channels, id=channel).name, message.guild.name)
-            await bot.reply(message, "", title="Fetching: {}".format(title))
-            cursor = bot.logdb.cursor()
-            cursor.execute('''
-                SELECT m.time, CASE WHEN n.nick IS NULL THEN u.name else n.nick END as name, m.text FROM messages AS m
-                INNER JOIN users AS u ON m.user = u.user
-                INNER JOIN nicks AS n ON m.guild = n.guild AND m.user = n.user
-                WHERE m.guild = ? AND m.channel = ?
-                ORDER BY m.time ASC
-            ''', (message.guild.id, channel))
-            data = [Entry(e) for e in cursor.fetchall()]
         else:
             title = "Top Users for server **{}**".format(message.guild.name)
-            await bot.reply(message, "", title="Fetching: {}".format(title))
-            cursor = bot.logdb.cursor()
-            cursor.execute('''
-                SELECT m.time, CASE WHEN n.nick IS NULL THEN u.name else n.nick END as name, m.text FROM messages AS m
-                INNER JOIN users AS u ON m.user = u.user
-                INNER JOIN nicks AS n ON m.guild = n.guild AND m.user = n.user
-                WHERE m.guild = ?
-                ORDER BY m.time ASC
-            ''', (message.guild.id,))
-            data = [Entry(e) for e in cursor.fetchall()]
+        await bot.reply(message, "", title="Fetching: {}".format(title), progress=True)
+        await bot.load_columns(message.guild.id)
+        users, total, words = await bot.client.loop.run_in_executor(bot.query_pool, bot.rollup_summary, message.guild.id, channel)
 
-        await bot.reply(message, "{} messages".format(len(data)), title="Calculating: {}".format(title))
+        await bot.reply(message, "{} messages".format(total), title="Calculating: {}".format(title), progress=True)
 
-        uname = None
         if len(params) == 2:
             user = params[1].strip("<!@>")
             if user.isdigit():
@@ -1391,127 +2623,67 @@ if __name__ == "__main__":
             else:
                 await bot.reply(message, "ERROR: Please enter a valid user.", colour=discord.Colour.red())
                 return
-            cursor.execute('''
-                SELECT CASE WHEN n.nick IS NULL THEN u.name ELSE n.nick END as name FROM users AS u
-                INNER JOIN nicks AS n ON n.guild = ? AND n.user = u.user
-                WHERE u.user = ?
-            ''', (message.guild.id, user))
-            name = cursor.fetchone()
-            if name is None:
-                member = message.guild.get_member(user)
-                if m is not None:
-                    uname = member.display_name
-                else:
-                    user = bot.client.get_user(user)
-                    uname = user.name
-            else:
-                uname = name[0]
-        earliest = {}
-        msgcounts = {}
-        wordcounts = {}
-        for entry in data:
-            earliest[entry.name] = min(earliest[entry.name], entry.time) if earliest.get(entry.name, None) else entry.time
-            msgcounts[entry.name] = msgcounts.get(entry.name, 0) + 1
-            wordcounts[entry.name] = wordcounts.get(entry.name, 0) + len(entry.text.split(' '))
-        avgwpl = {k: v/msgcounts[k] for k, v in wordcounts.items()}
-        avgmps = {k: v/(time.time() - earliest[k]) for k, v in msgcounts.items()}
-
-        if len(params) == 2:
-            fields = {"Messages sent": msgcounts[uname], "Words per line": avgwpl[uname], "Lines per day": avgmps[uname]*86400}
-            await bot.reply(message, "*{} messages total*".format(len(data)), title=title, fields=fields)
+            rows = await bot.client.loop.run_in_executor(bot.query_pool, bot.user_totals, message.guild.id, channel, user)
+            if not rows:
+                await bot.reply(message, "I have not seen {} in there.".format(params[1]), colour=discord.Colour.orange())
+                return
+            _, name, msgcount, wordcount, earliest = rows[0]
+            fields = {"Messages sent": msgcount, "Words per line": wordcount/msgcount, "Lines per day": msgcount/(time.time() - earliest)*86400}
+            await bot.reply(message, "*{} messages total*".format(total), title=title, fields=fields)
         else:
-            fields = collections.OrderedDict([(k, "{} messages".format(msgcounts[k])) for k in sorted(msgcounts, key=msgcounts.get, reverse=True)[:10]])
-            await bot.reply(message, "*{} users total*\n**Top 10 users**:".format(len(msgcounts)), title=title, fields=fields, footer="Page 1")
-            fields = collections.OrderedDict([(k, "{} words/line".format(int(avgwpl[k]))) for k in sorted(avgwpl, key=avgwpl.get, reverse=True)[:10]])
-            message = await message.channel.send("{} words total\nTop 10 users:".format(sum(wordcounts.values())))
-            await bot.reply(message, "*{} words total*\n**Top 10 users**:".format(sum(wordcounts.values())), title=title, fields=fields, footer="Page 2")
-            fields = collections.OrderedDict([(k, "{:.2f} lines/day".format(avgmps[k]*86400)) for k in sorted(avgmps, key=avgmps.get, reverse=True)[:10]])
-            message = await message.channel.send("{} messages total\nTop 10 users:".format(len(data)))
-            await bot.reply(message, "*{} messages total*\n**Top 10 users**:".format(len(data)), title=title, fields=fields, footer="Page 3")
+            totals = await bot.client.loop.run_in_executor(bot.query_pool, functools.partial(bot.user_totals, message.guild.id, channel, limit=10))
+            fields = collections.OrderedDict([(row[1], "{} messages".format(row[2])) for row in totals])
+            await bot.reply(message, "*{} users total*\n**Top 10 users**:".format(users), title=title, fields=fields, footer="Page 1")
+            totals = await bot.client.loop.run_in_executor(bot.query_pool, functools.partial(bot.user_totals, message.guild.id, channel, order='words', limit=10))
+            fields = collections.OrderedDict([(row[1], "{} words/line".format(int(row[3]/row[2]))) for row in totals])
+            message = await message.channel.send("{} words total\nTop 10 users:".format(words))
+            await bot.reply(message, "*{} words total*\n**Top 10 users**:".format(words), title=title, fields=fields, footer="Page 2")
+            totals = await bot.client.loop.run_in_executor(bot.query_pool, functools.partial(bot.user_totals, message.guild.id, channel, order='rate', limit=10))
+            fields = collections.OrderedDict([(row[1], "{:.2f} lines/day".format(row[2]/(time.time() - row[4])*86400)) for row in totals])
+            message = await message.channel.send("{} messages total\nTop 10 users:".format(total))
+            await bot.reply(message, "*{} messages total*\n**Top 10 users**:".format(total), title=title, fields=fields, footer="Page 3")
 
     @bot.cmd("```\n{0} [user]\n\n Get stats about the server or a user```", pm=False)
     async def topchans(bot, message, parameters, recursion=0):
         params = parameters.split(' ')
         title = "Stats"
-        data = []
 
         if len(params) > 1:
             await bot.reply(message, bot.commands['topchans'][1].format(message.clean_content.split(' ', 1)[0]), colour=discord.Colour.purple())
             return
 
-        class Entry:
-            def __init__(self, entry):
-                self.chan = entry[0]
-                self.name = entry[1]
-                self.text = entry[2]
-
         if parameters:
             title = "Top Chans for **{}** on server **{}**".format(params[0], message.guild.name)
         else:
             title = "Top Chans for server **{}**".format(message.guild.name)
-        await bot.reply(message, "", title="Fetching: {}".format(title))
-        cursor = bot.logdb.cursor()
-        cursor.execute('''
-            SELECT c.name, CASE WHEN n.nick IS NULL THEN u.name else n.nick END as name, m.text FROM messages AS m
-            INNER JOIN channels AS c ON m.channel = c.channel
-            INNER JOIN users AS u ON m.user = u.user
-            INNER JOIN nicks AS n ON m.guild = n.guild AND m.user = n.user
-            WHERE m.guild = ? AND m.type = 0
-            ORDER BY m.time ASC
-        ''', (message.guild.id,))
-        data = [Entry(e) for e in cursor.fetchall()]
+        await bot.reply(message, "", title="Fetching: {}".format(title), progress=True)
+        await bot.load_columns(message.guild.id)
 
-        uname = None
+        user = None
         if parameters:
-            await bot.reply(message, "{} messages".format(len(data)), title="Trimming: {}".format(title))
             user = params[0].strip("<!@>")
             if user.isdigit():
                 user = int(user)
             else:
                 await bot.reply(message, "ERROR: Please enter a valid user.", colour=discord.Colour.red())
                 return
-            cursor.execute('''
-                SELECT CASE WHEN n.nick IS NULL THEN u.name ELSE n.nick END as name FROM users AS u
-                INNER JOIN nicks AS n ON n.guild = ? AND n.user = u.user
-                WHERE u.user = ?
-            ''', (message.guild.id, user))
-            name = cursor.fetchone()
-            if name is None:
-                member = message.guild.get_member(user)
-                if m is not None:
-                    uname = member.display_name
-                else:
-                    user = bot.client.get_user(user)
-                    uname = user.name
-            else:
-                uname = name[0]
-            data = [e for e in data if e.name == uname]
-        await bot.reply(message, "{} messages".format(len(data)), title="Generating: {}".format(title))
+        totals = await bot.client.loop.run_in_executor(bot.query_pool, bot.channel_totals, message.guild.id, user)
+        if not totals:
+            await bot.reply(message, "No messages logged.", title=title, colour=discord.Colour.orange())
+            return
+        await bot.reply(message, "{} messages".format(sum(row[2] for row in totals)), title="Generating: {}".format(title), progress=True)
 
-        channelcounts = {}
-        for entry in data:
-            channelcounts[entry.chan] = channelcounts.get(entry.chan, 0) + 1
-        channelcounts = collections.OrderedDict([(k,channelcounts[k]) for k in sorted(channelcounts, key=channelcounts.get)])
+        channelcounts = collections.OrderedDict([(row[1], row[2]) for row in reversed(totals)])
 
         labels, counts = zip(*channelcounts.items())
         sizes = [100*(x/sum(counts)) for x in counts]
 
-        await bot.reply(message, "{} messages total in {} channels".format(len(data), len(labels)), title="Rendering: {}".format(title))
-        import matplotlib
-        matplotlib.use('Agg')
-        import matplotlib.pyplot
-        matplotlib.pyplot.close("all")
-        fig, ax = matplotlib.pyplot.subplots(1, 1)
-        ax.pie(sizes, labels=labels, autopct="%1.1f%%", shadow=True)
-        ax.axis('equal')
-        matplotlib.pyplot.tight_layout()
-        imgdata = BytesIO()
-        matplotlib.pyplot.savefig(imgdata, format="PNG")
-        imgdata.seek(0)
-        await message.channel.send(title, file=discord.File(imgdata, filename="stats.png"))
+        await bot.reply(message, "{} messages total in {} channels".format(sum(counts), len(labels)), title="Rendering: {}".format(title), progress=True)
+        imgdata = await bot.render(message, render_pie, labels, sizes)
+        await message.channel.send(title, file=discord.File(BytesIO(imgdata), filename="stats.png"))
 
         fields = collections.OrderedDict([(k, "{} messages".format(channelcounts[k])) for k in sorted(channelcounts, key=channelcounts.get, reverse=True)[:10]])
-        await bot.reply(message, "*{} messages total in {} channels*\n**Top channels**:".format(len(data), len(labels)), title=title, fields=fields)
+        await bot.reply(message, "*{} messages total in {} channels*\n**Top channels**:".format(sum(counts), len(labels)), title=title, fields=fields)
 
     bot.run()
 